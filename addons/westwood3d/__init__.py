@@ -16,12 +16,14 @@ if "bpy" in locals():
     import imp
     imp.reload(w3d_material)
     imp.reload(w3d_struct)
+    imp.reload(w3d_mix)
+    imp.reload(w3d_search)
     imp.reload(w3d_aggregate)
     imp.reload(w3d_util)
     imp.reload(w3d_import)
     imp.reload(w3d_export)
 else:
-    from . import w3d_material, w3d_struct, w3d_aggregate, w3d_util, w3d_import, w3d_export
+    from . import w3d_material, w3d_struct, w3d_mix, w3d_search, w3d_aggregate, w3d_util, w3d_import, w3d_export
 
 import bpy
 
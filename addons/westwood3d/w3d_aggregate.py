@@ -1,7 +1,9 @@
-import os
-from . import w3d_struct
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from . import w3d_struct, w3d_search
 
-from typing import BinaryIO, List
+from typing import Dict, List, Optional
 
 class MissingFileError(Exception):
     """Exception raised when an aggregate was not found.
@@ -16,17 +18,110 @@ class MissingFileError(Exception):
     def __str__(self):
         return self.message
 
-def aggregate(root, paths: List[str]):
-    ag_rec(root, root, paths)
+# Chunks the importer has no use for, not even loaded
+unused_chunks = ('aabtree',)
 
-def ag_rec(node: w3d_struct.node, root: w3d_struct.node, paths, loaded={}):
+class AggregateSession():
+    """Keeps the dependencies aggregate() loads, so that the files of an
+    import that share them (hierarchies, common aggregates) don't load
+    them again.
+
+    The trees kept here are never modified, aggregate() adds copies of
+    them. A tree is only decoded when the first copy of it is made, so the
+    files an import looks at but doesn't use stay undecoded, and the ones
+    it uses are decoded once per session.
+
+    The least recently used trees go once they add up to more than budget
+    bytes, counted as the size of their files.
+    """
+    def __init__(self, budget=256 << 20):
+        self.budget = budget
+        self.size = 0
+
+        # load() is called from aggregate()'s threads, and the trees are
+        # decoded under it
+        self.lock = threading.Lock()
+
+        # (name, paths) -> (tree, size of the file), least recently used first
+        self.trees = OrderedDict()
+
+    def load(self, file: str, paths: List[str]) -> w3d_struct.node:
+        """ag_load through the session: returns the tree of the dependency
+        named file, as kept by the session. Only look at it through deps()
+        and copy().
+        """
+        key = (file.lower(), tuple(paths))
+        with self.lock:
+            if key in self.trees:
+                self.trees.move_to_end(key)
+                return self.trees[key][0]
+
+        root, filename = ag_open(file, paths)
+        size = w3d_search.getsize(filename)
+
+        with self.lock:
+            # Another thread may have loaded it meanwhile, keep that one
+            if key not in self.trees:
+                self.size += size
+                self.trees[key] = (root, size)
+            self.trees.move_to_end(key)
+
+            # The newest tree is always kept, even if it's over the budget
+            while self.size > self.budget and len(self.trees) > 1:
+                self.size -= self.trees.popitem(last=False)[1][1]
+
+            return self.trees[key][0]
+
+    def deps(self, root: w3d_struct.node, hlod=True):
+        """ag_deps of a tree returned by load().
+        """
+        with self.lock:
+            return ag_deps(root, hlod)
+
+    def copy(self, root: w3d_struct.node) -> w3d_struct.node:
+        """Decodes a tree returned by load(), if it hasn't been yet, and
+        returns a copy of it.
+        """
+        with self.lock:
+            ag_decode(root)
+        return root.clone()
+
+    def clear(self):
+        with self.lock:
+            self.trees.clear()
+            self.size = 0
+
+def aggregate(root, paths: List[str], session: Optional[AggregateSession] = None, workers=None):
+    """Adds the chunks of the files root depends on to root.
+
+    The files are found and loaded on workers threads, all the files a
+    level of the dependency graph needs at once. Only the ones added to
+    root are decoded, and they are added in the same order as if they were
+    loaded one after the other.
+
+    Pass the same session to import several files that share dependencies.
+    """
+    if session is None:
+        session = AggregateSession()
+
+    with ThreadPoolExecutor(workers) as pool:
+        trees = ag_discover(root, paths, session, pool)
+
+    ag_rec(root, root, {}, trees, session)
+
+def ag_deps(node: w3d_struct.node, hlod=True):
+    """Reads the headers of node that ag_rec looks at. Returns the names
+    node provides, the files its hlod needs (hlod=False ignores it, as if
+    it was removed) and the files its aggregates need.
+    """
+    names = []
     expfiles = {}
     impfiles = {}
     
     # load aggregates
     ag = node.get('aggregate')
     if ag is not None:
-        loaded[ag.get('aggregate_header').Name] = True
+        names.append(ag.get('aggregate_header').Name)
         
         ainfo = ag.get('aggregate_info')
         expfiles[ainfo.BaseModelName] = True
@@ -36,14 +131,14 @@ def ag_rec(node: w3d_struct.node, root: w3d_struct.node, paths, loaded={}):
     # mark hierarchy as loaded
     hierarchy = node.get('hierarchy')
     if hierarchy is not None:
-        loaded[hierarchy.get('hierarchy_header').Name] = True
+        names.append(hierarchy.get('hierarchy_header').Name)
     
     # hlod
-    hlod = node.get('hlod')
+    hlod = node.get('hlod') if hlod else None
     if hlod is not None:
         # hierarchy
         hinfo = hlod.get('hlod_header')
-        loaded[hinfo.Name] = True
+        names.append(hinfo.Name)
         
         impfiles[hinfo.HierarchyName] = True
         
@@ -56,41 +151,101 @@ def ag_rec(node: w3d_struct.node, root: w3d_struct.node, paths, loaded={}):
             for h in lod.find('hlod_sub_object'):
                 expfiles[h.Name] = True
     
+    return names, list(impfiles), list(expfiles)
+
+def ag_discover(root: w3d_struct.node, paths: List[str], session: AggregateSession, pool: ThreadPoolExecutor):
+    """Loads every file root may depend on, a level of the dependency graph
+    at a time. That can be a few more than ag_rec uses, it also skips files
+    whose names were provided by a file it went through before.
+
+    Returns file name -> future of the tree, as kept by session; a file
+    that fails to load only raises if ag_rec needs it.
+    """
+    trees: Dict[str, Future] = {}
+
+    # Trees whose dependencies are still to be looked at, with whether
+    # their hlod is used (it isn't for implicit dependencies)
+    level = [(root, True)]
+    followed = set()
+
+    # Always marked as loaded before anything is
+    provided = set(ag_deps(root)[0])
+
+    while level:
+        wanted = []
+        for n, hlod in level:
+            names, impfiles, expfiles = ag_deps(n, hlod) if n is root else session.deps(n, hlod)
+            for f, hlod in [(f, False) for f in impfiles] + [(f, True) for f in expfiles]:
+                # Same for the names of the file that needs f
+                if f in provided or f in names:
+                    continue
+                if (f, hlod) not in followed:
+                    followed.add((f, hlod))
+                    wanted.append((f, hlod))
+
+        for f, hlod in wanted:
+            if f not in trees:
+                trees[f] = pool.submit(session.load, f, paths)
+
+        level = [(trees[f].result(), hlod) for f, hlod in wanted if trees[f].exception() is None]
+
+    return trees
+
+def ag_decode(root: w3d_struct.node):
+    # Decoding errors are left for whoever uses the chunk, it stays lazy
+    for n in root.children:
+        try:
+            n.resolve()
+        except Exception:
+            pass
+
+def ag_rec(node: w3d_struct.node, root: w3d_struct.node, loaded: Dict[str, bool], trees: Dict[str, Future], session: AggregateSession):
+    names, impfiles, expfiles = ag_deps(node)
+    for name in names:
+        loaded[name] = True
+    
     # Implicit aggregation
-    for f in impfiles.keys():
+    for f in impfiles:
         if f not in loaded:
             loaded[f] = True
-            n = ag_load(f, paths)
+            n = session.copy(trees[f].result())
             
             # remove hlod
             ch = n.get('hlod')
             if ch is not None:
-                n.children.remove(ch)
+                n.remove(ch)
             
-            root.children += n.children
-            ag_rec(n, root, paths, loaded)
+            root.extend(n.children)
+            ag_rec(n, root, loaded, trees, session)
             
     # Explicit aggregation
-    for f in expfiles.keys():
+    for f in expfiles:
         if f not in loaded:
             loaded[f] = True
-            n = ag_load(f, paths)
-            root.children += n.children
-            ag_rec(n, root, paths, loaded)
+            n = session.copy(trees[f].result())
+            root.extend(n.children)
+            ag_rec(n, root, loaded, trees, session)
     
 def ag_load(file: str, paths: List[str]):
-    root = None
-    
-    for path in paths:
-        filename = os.path.join(path, file.lower() + '.w3d')
-        try:
-            root = w3d_struct.load(filename)
-            break
-        except:
-            pass
-    
-    if root is None:
+    return ag_open(file, paths)[0]
+
+def ag_open(file: str, paths: List[str]):
+    """Loads the dependency named file from the first of paths that has it.
+    Returns the tree and the name of the file it was loaded from.
+    """
+    filename = w3d_search.find(paths, file + '.w3d')
+    if filename is None:
         print('MISSING: ' + file.lower() + '.w3d')
-        raise MissingFileError(file.lower() + '.w3d', "File not found or corrupted: " + file.lower() + ".w3d")
+        raise MissingFileError(file.lower() + '.w3d', "File not found: " + file.lower() + ".w3d")
+
+    # Most of a dependency is only needed once it is imported,
+    # so only decode what ag_rec actually looks at.
+    data = w3d_search.buffer(filename)
+    if data is None:
+        root = w3d_struct.load(filename, lazy=True, exclude=unused_chunks)
+    else:
+        # In an archive
+        print('load: ' + filename)
+        root = w3d_struct.load_buffer(data, lazy=True, exclude=unused_chunks)
     
-    return root
\ No newline at end of file
+    return root, filename
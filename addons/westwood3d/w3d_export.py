@@ -26,22 +26,22 @@ def make_material(ob, mesh, uvlayers):
             vinfo = m.add('vertex_material_info')
             
             # shader
-            shaders.shaders.append({
-                'SrcBlend': 1,
-                'DestBlend': 0,
-                'DepthMask': 1,
-                'AlphaTest': 0,
+            shaders.shaders.append(w3d_struct.record_shader(
+                SrcBlend=1,
+                DestBlend=0,
+                DepthMask=1,
+                AlphaTest=0,
                 
-                'PriGradient': 1,
-                'SecGradient': 0,
-                'DepthCompare': 3,
-                'DetailColorFunc': 0,
-                'DetailAlphaFunc': 0,
+                PriGradient=1,
+                SecGradient=0,
+                DepthCompare=3,
+                DetailColorFunc=0,
+                DetailAlphaFunc=0,
                 
-                'Texturing': 0,
-                'PostDetailColorFunc': 0,
-                'PostDetailAlphaFunc': 0
-            })
+                Texturing=0,
+                PostDetailColorFunc=0,
+                PostDetailAlphaFunc=0
+            ))
     
             # stages
             for s in (p.stage0, p.stage1):
@@ -103,12 +103,12 @@ def make_mesh(ob, root, ctrname):
     
     vidx = 0
     for f in bm.faces:
-        tris.triangles.append({
-            'Vindex': (vidx, vidx + 1, vidx + 2),
-            'Attributes': 13,
-            'Normal': (f.normal[0], f.normal[1], f.normal[2]),
-            'Dist': 1
-        })
+        tris.triangles.append(w3d_struct.record_triangle(
+            Vindex=(vidx, vidx + 1, vidx + 2),
+            Attributes=13,
+            Normal=(f.normal[0], f.normal[1], f.normal[2]),
+            Dist=1
+        ))
         for v in f.verts:
             verts.vertices.append((v.co[0], v.co[1], v.co[2]))
             norms.normals.append((v.normal[0], v.normal[1], v.normal[2]))
@@ -170,13 +170,13 @@ def write_some_data(context, filepath, use_some_setting):
     
     pnode = node.add('pivots')
     for p in pivots:
-        pnode.pivots.append({
-            'Name': p[0],
-            'ParentIdx': p[1],
-            'Translation': p[2],
-            'EulerAngles': p[3].to_euler(),
-            'Rotation': (p[3][1],p[3][2],p[3][3],p[3][0])
-        })
+        pnode.pivots.append(w3d_struct.record_pivot(
+            Name=p[0],
+            ParentIdx=p[1],
+            Translation=p[2],
+            EulerAngles=p[3].to_euler(),
+            Rotation=(p[3][1],p[3][2],p[3][3],p[3][0])
+        ))
     
     # meshes
     for id, ob in subobj:
@@ -4,7 +4,12 @@ import mathutils
 import os
 from typing import cast
 
-from . import w3d_struct, w3d_aggregate, w3d_util
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from . import w3d_struct, w3d_search, w3d_aggregate, w3d_util
 
 def make_mats(materials):
     for mdata in materials:
@@ -174,10 +179,13 @@ def deform_mesh(mesh, mdata, pivots):
         return
     inf = inf.influences
     
+    # The vertices were welded, Vorigin has the original index of each
+    origin = mdata.Vorigin
+
     bm = bmesh.new()
     bm.from_mesh(mesh)
     for v in bm.verts:
-        v.co = pivots[inf[v.index]]['blender_object'].matrix_world @ v.co
+        v.co = pivots[inf[origin[v.index]]]['blender_object'].matrix_world @ v.co
     bm.normal_update()
     bm.to_mesh(mesh)
 
@@ -207,6 +215,72 @@ def make_shapes(root, collection):
         s.blender_object = ob
 
 
+def fill_mesh(me, verts, remap, faces, mindex, fullname):
+    """Gives the empty mesh me its vertices and triangles, with their
+    material indices, all at once. remap is the index in verts of each of
+    the vertices the triangles use (see w3d_util.weld_vertices). Triangles
+    Blender can't have (a duplicate, a repeated or missing vertex) are left
+    out. Returns the vertex index, before remap, of every loop.
+    """
+    if np is not None and isinstance(faces, np.ndarray):
+        vindex = faces['Vindex']
+    else:
+        vindex = [f['Vindex'] for f in faces]
+
+    # Triangles with a vertex that doesn't exist point past verts, so
+    # mesh_faces drops them
+    if np is not None:
+        vindex = np.asarray(vindex, dtype=np.int64).reshape(-1, 3)
+        valid = (vindex < len(remap)).all(axis=1)
+        welded = np.full(vindex.shape, len(verts), dtype=np.int64)
+        welded[valid] = np.asarray(remap, dtype=np.int64)[vindex[valid]]
+    else:
+        welded = [[remap[i] if i < len(remap) else len(verts) for i in f] for f in vindex]
+
+    keep = w3d_util.mesh_faces(welded, len(verts))
+    if len(keep) < len(faces):
+        print("duplicate faces encountered on: " + fullname)
+    count = len(keep)
+
+    # Vertex index of every loop
+    if np is not None:
+        loops = vindex[keep].ravel()
+        geometry = welded[keep].ravel().astype(np.int32)
+    else:
+        loops = [i for f in keep for i in vindex[f]]
+        geometry = [i for f in keep for i in welded[f]]
+
+    me.vertices.add(len(verts))
+    me.loops.add(count * 3)
+    me.polygons.add(count)
+
+    if np is not None:
+        me.vertices.foreach_set('co', np.asarray(verts, dtype=np.float32).ravel())
+        me.loops.foreach_set('vertex_index', geometry)
+        me.polygons.foreach_set('loop_start', np.arange(0, count * 3, 3, dtype=np.int32))
+        me.polygons.foreach_set('loop_total', np.full(count, 3, dtype=np.int32))
+        me.polygons.foreach_set('material_index', np.asarray(mindex, dtype=np.int32)[keep])
+    else:
+        me.vertices.foreach_set('co', [c for v in verts for c in v])
+        me.loops.foreach_set('vertex_index', geometry)
+        me.polygons.foreach_set('loop_start', list(range(0, count * 3, 3)))
+        me.polygons.foreach_set('loop_total', [3] * count)
+        me.polygons.foreach_set('material_index', [mindex[f] for f in keep])
+
+    me.update(calc_edges=True)
+    return loops
+
+def set_loop_colors(me, name, colors):
+    """Adds a per loop byte color layer to me with colors, flat RGBA floats
+    stored as they are.
+    """
+    if hasattr(me, 'vertex_colors'):
+        me.vertex_colors.new(name=name).data.foreach_set('color', colors)
+    else:
+        # Blender 4 only has color attributes, 'color' would be linear
+        layer = me.color_attributes.new(name, 'BYTE_COLOR', 'CORNER')
+        layer.data.foreach_set('color_srgb', colors)
+
 def make_meshes(root: w3d_struct.node, collection):
     meshes = root.find('mesh')
     for m in meshes:
@@ -220,76 +294,32 @@ def make_meshes(root: w3d_struct.node, collection):
         mpass = m.findRec('material_pass')
 
         tids = m.getRec('texture_ids')
-        if tids != None:
+        if tids is not None:
             tids = tids.ids
 
+        # Remove double vertices. UVs and colors stay those of the
+        # original vertices, per loop, so they survive the merge.
+        verts, m.Vorigin, remap = w3d_util.weld_vertices(verts, 0.0001)
+
         # create mesh
         me = bpy.data.meshes.new(fullname)
+        loops = fill_mesh(me, verts, remap, faces, m.Mindex, fullname)
 
         for p in range(len(mpass)):
             uvs = mpass[p].findRec('stage_texcoords')
             for uv in range(len(uvs)):
                 me.uv_layers.new(name='pass' + str(p + 1) + '.' + str(uv))
 
-        bm = bmesh.new()
-        bm.from_mesh(me)
-
-        for v in verts:
-            bm.verts.new(v)
-
-        # Refresh the lookup table.
-        if hasattr(bm.verts, "ensure_lookup_table"): 
-            bm.verts.ensure_lookup_table()
-
-        for f in faces:
-            try:
-                bm.faces.new([bm.verts[i] for i in f['Vindex']]).material_index = f['Mindex']
-            except:
-                print("duplicate faces encountered on: " + fullname)
-
-        if hasattr(bm.faces, "ensure_lookup_table"):
-            bm.faces.ensure_lookup_table()
-
-        if hasattr(bm.edges, "ensure_lookup_table"):
-            bm.edges.ensure_lookup_table()
-
-        # vertex color information
+        # vertex color information, the vertices' colors gathered per loop
         for p in range(len(mpass)):
             dcg = mpass[p].get('dcg')
             if dcg is not None:
-                alpha = False
-                for c in dcg.dcg:
-                    if c[3] < 255:
-                        alpha = True
-                        break
-
-                layer = bm.loops.layers.color.new('pass' + str(p + 1))
-                for v in range(len(bm.verts)):
-                    for loop in bm.verts[v].link_loops:
-                        col = dcg.dcg[v]
-                        if alpha:
-                            loop[layer].x = col[3] / 255
-                            loop[layer].y = col[3] / 255
-                            loop[layer].z = col[3] / 255
-                        else:
-                            loop[layer].x = col[0] / 255
-                            loop[layer].y = col[1] / 255
-                            loop[layer].z = col[2] / 255
+                set_loop_colors(me, 'pass' + str(p + 1), w3d_util.loop_colors(dcg.dcg, loops))
 
         # Transfer UVs
         uvs = m.findRec('stage_texcoords')
-        for uvi in range(len(uvs)):
-            layer = bm.loops.layers.uv[uvi]
-            for v in range(len(bm.verts)):
-                for loop in bm.verts[v].link_loops:
-                    loop[layer].uv = uvs[uvi].texcoords[v]
-
-        # Remove double vertices
-        bmesh.ops.remove_doubles(bm, verts=bm.verts, dist=0.0001)
-
-        bm.normal_update()
-        bm.to_mesh(me)
-        bm.free()
+        for uvi in range(min(len(uvs), len(me.uv_layers))):
+            me.uv_layers[uvi].data.foreach_set('uv', w3d_util.loop_values(uvs[uvi].texcoords, loops))
 
         # attach to object, place in scene
         ob = bpy.data.objects.new(fullname, me)
@@ -318,7 +348,7 @@ def make_meshes(root: w3d_struct.node, collection):
             ob.data.materials.append(mat['BlenderMaterial'])
 
         # assign textures to uv map
-        if tids != None and len(tids) > 0 and len(tex) > 0:
+        if tids is not None and len(tids) > 0 and len(tex) > 0:
             for uvlay in me.uv_layers:
                 i = 0
                 for foo in uvlay.data:
@@ -393,6 +423,16 @@ def make_lights(root, collection):
             light_data.energy = li.Intensity * power_mult
 
 
+def load_packed_image(filepath: str, data: memoryview):
+    """Makes an image of a file in an archive. Blender can only read those
+    packed into the blend file.
+    """
+    img = bpy.data.images.new(os.path.basename(filepath), 1, 1)
+    img.filepath_raw = filepath
+    img.pack(data=bytes(data), data_len=len(data))
+    img.source = 'FILE'
+    return img
+
 def load_images(root: w3d_struct.node, paths):
     # get every image
     filenames = root.findRec('texture_name')
@@ -410,21 +450,18 @@ def load_images(root: w3d_struct.node, paths):
             continue
 
         img = None
-        for path in paths:
+        filepath, fn.name = w3d_search.find_texture(paths, fn.name)
+        if filepath is not None:
             try:
-                img = bpy.data.images.load(os.path.join(path, fn.name))
-            except:
-                # if it failed, try again with .dds
-                try:
-                    ddsname = os.path.splitext(fn.name)[0] + '.dds'
-                    img = bpy.data.images.load(os.path.join(path, ddsname))
-                    fn.name = ddsname
-                except:
-                    pass
-
-            # If image loaded, break
-            if img != None:
-                break
+                data = w3d_search.buffer(filepath)
+                if data is None:
+                    img = bpy.data.images.load(filepath, check_existing=True)
+                else:
+                    img = load_packed_image(filepath, data)
+                # The file's case may differ, materials look it up by this
+                img.name = fn.name
+            except RuntimeError as e:
+                print(str(e))
 
         if img == None:
             print('image not loaded: ' + fn.name)
@@ -541,25 +578,16 @@ def make_anim(anim):
     # TODO: w3d animations have multiple channels, channels are applied to individual pivot points
     # However, blender doesn't allow multiple objects to share a single action without sharing the movements as well.
     # So we have to create actions for each pivot point
+    actions = {}
 
     for channel in anim['channels']:
         pivot = channel['pivot']
+        if pivot is None:
+            continue
         bobj = pivot['blender_object']
         bobj.rotation_mode = 'QUATERNION'
 
-        action = None
-        actName = anim['name'] + '.' + pivot['name']
-        if bpy.data.actions.find(actName) == -1:
-            action = bpy.data.actions.new(name=actName)
-        else:
-            # Hijack the existing action, clear its data.
-            action = bpy.data.actions.get(actName)
-            for c in action.fcurves:
-                action.fcurves.remove(c)
-
-        if bobj.animation_data == None:
-            bobj.animation_data_create()
-            bobj.animation_data.action = action
+        action = anim_action(bobj, anim['name'] + '.' + pivot['name'], actions)
 
         datatype = ''
         idx = -1
@@ -586,7 +614,7 @@ def make_anim(anim):
             idx = -1
 
         firstFrame = channel['firstframe']
-        lastFrame = channel['lastframe']
+        data = channel['data']
 
         # Channel data stuff is an offset from the object's original position.
         # Not quaternion
@@ -595,11 +623,10 @@ def make_anim(anim):
 
             initialLoc = bobj.location[idx]
 
-            curFrame = firstFrame
-            for vec in channel['data']:
-                fcu.keyframe_points.insert(curFrame, initialLoc + vec[0])
-
-                curFrame += 1
+            if np is not None:
+                set_keyframes(fcu, firstFrame, initialLoc + data[:, 0])
+            else:
+                set_keyframes(fcu, firstFrame, [initialLoc + vec[0] for vec in data])
         elif channel['type'] == 'Q':
             # Quaternions are special. 4 vector components are included in the data instead of just 1
             # Also blender is backwards and defines quaternions as w x y z, w3d x y z w
@@ -609,17 +636,94 @@ def make_anim(anim):
 
             initialQuat = mathutils.Quaternion(bobj.rotation_quaternion)
 
-            curFrame = firstFrame
-            for vec in channel['data']:
-                quat = mathutils.Quaternion((vec[3], vec[0], vec[1], vec[2]))
-                rotQuat = initialQuat @ quat
+            if np is not None:
+                # initialQuat @ quat for every frame at once
+                w0, x0, y0, z0 = initialQuat
+                x, y, z, w = data[:, 0], data[:, 1], data[:, 2], data[:, 3]
+                rotQuat = (
+                    w0 * w - x0 * x - y0 * y - z0 * z,
+                    w0 * x + x0 * w + y0 * z - z0 * y,
+                    w0 * y - x0 * z + y0 * w + z0 * x,
+                    w0 * z + x0 * y - y0 * x + z0 * w,
+                )
+            else:
+                rotQuats = [initialQuat @ mathutils.Quaternion((vec[3], vec[0], vec[1], vec[2])) for vec in data]
+                rotQuat = [[q[i] for q in rotQuats] for i in range(4)]
+
+            for i in range(0, 4):
+                set_keyframes(fcus[i], firstFrame, rotQuat[i])
+
+    # Visibility hides the meshes of the pivot. Only the frames where it
+    # changes are keyed, and the keys hold until the next one.
+    for channel in anim['bitchannels']:
+        pivot = channel['pivot']
+        if pivot is None or channel['type'] != 'VIS':
+            continue
+
+        objects = [pivot['blender_object']]
+        for data, lod in pivot['obj']:
+            if data.blender_object not in objects:
+                objects.append(data.blender_object)
+
+        if np is not None:
+            hidden = 1.0 - np.asarray(channel['values'], dtype=np.float32)
+        else:
+            hidden = [0.0 if v else 1.0 for v in channel['values']]
+
+        for bobj in objects:
+            action = anim_action(bobj, anim['name'] + '.' + bobj.name, actions)
+            for datatype in ('hide_viewport', 'hide_render'):
+                fcu = action.fcurves.new(datatype)
+                set_keyframes(fcu, channel['frames'], hidden, 'CONSTANT')
+
+def anim_action(bobj, actName, actions):
+    """The action of bobj in this animation, named actName if it's new. An
+    existing one is hijacked and cleared the first time it is used
+    (actions: object name -> action).
+    """
+    action = actions.get(bobj.name)
+    if action is None:
+        if bpy.data.actions.find(actName) == -1:
+            action = bpy.data.actions.new(name=actName)
+        else:
+            # Hijack the existing action, clear its data.
+            action = bpy.data.actions.get(actName)
+            for c in list(action.fcurves):
+                action.fcurves.remove(c)
+        actions[bobj.name] = action
+
+    if bobj.animation_data == None:
+        bobj.animation_data_create()
+        bobj.animation_data.action = action
+
+    return action
+
+def set_keyframes(fcu, frames, values, interpolation=None):
+    """Adds a keyframe for each of values, all at once. frames is the first
+    frame, the others follow, or the frame of every value.
+    """
+    count = len(values)
+    fcu.keyframe_points.add(count)
+
+    if isinstance(frames, int):
+        frames = range(frames, frames + count)
+
+    if np is not None:
+        co = np.empty((count, 2), dtype=np.float32)
+        co[:, 0] = frames
+        co[:, 1] = values
+        fcu.keyframe_points.foreach_set('co', co.ravel())
+    else:
+        co = []
+        for f, v in zip(frames, values):
+            co += (f, v)
+        fcu.keyframe_points.foreach_set('co', co)
 
-                fcus[0].keyframe_points.insert(curFrame, rotQuat.w)
-                fcus[1].keyframe_points.insert(curFrame, rotQuat.x)
-                fcus[2].keyframe_points.insert(curFrame, rotQuat.y)
-                fcus[3].keyframe_points.insert(curFrame, rotQuat.z)
+    if interpolation is not None:
+        for k in fcu.keyframe_points:
+            k.interpolation = interpolation
 
-                curFrame += 1
+    fcu.update()
 
 def load_scene(root: w3d_struct.node, collection: bpy.types.Collection, paths, ignore_lightmap):
     load_images(root, paths)
@@ -697,7 +801,7 @@ class ImportWestwood3D(Operator, ImportHelper):
         default=False
     )
 
-    def load_file(self, file):
+    def load_file(self, file, session):
         # source directories
         current_path = os.path.dirname(file)
         paths = [
@@ -709,13 +813,13 @@ class ImportWestwood3D(Operator, ImportHelper):
         
         # Load data
         try:
-            root = w3d_struct.load(file)
+            root = w3d_struct.load(file, exclude=w3d_aggregate.unused_chunks)
         except Exception as e:
             self.report({"ERROR"}, str(e))
             return {"CANCELLED"}
 
         try:
-            w3d_aggregate.aggregate(root, paths)
+            w3d_aggregate.aggregate(root, paths, session)
         except Exception as e:
             self.report({"ERROR"}, str(e))
             return {"CANCELLED"}
@@ -728,8 +832,10 @@ class ImportWestwood3D(Operator, ImportHelper):
         return {'FINISHED'}
 
     def execute(self, context):
+        # Files imported together load their shared dependencies once
+        session = w3d_aggregate.AggregateSession()
         for f in self.files:
-            self.load_file(os.path.join(self.directory, f.name))
+            self.load_file(os.path.join(self.directory, f.name), session)
 
         return {'FINISHED'}
         
@@ -0,0 +1,85 @@
+"""Reads Renegade MIX archives (.mix, and .dat like always.dat) in place.
+
+The archive is mapped, its file table read once, and files are handed out
+as memoryviews of the map, so nothing is copied or extracted to disk.
+
+Layout, little endian:
+    'MIX1', offset of the file table, offset of the names table, 0
+    file table: count, then count times (CRC of the name, offset, size)
+    names table: count, then count times (length with the 0, name, 0)
+The names are in the same order as the file table.
+"""
+import struct
+from typing import Dict, List, Optional, Tuple
+
+from . import w3d_struct
+
+header = struct.Struct('<4sIII')
+count = struct.Struct('<I')
+file_entry = struct.Struct('<III')
+
+def is_archive(filepath: str) -> bool:
+    """Whether filepath starts like a MIX archive.
+    """
+    try:
+        with open(filepath, 'rb') as file:
+            return file.read(4) == b'MIX1'
+    except OSError:
+        return False
+
+class MixArchive():
+    """A mapped MIX archive. Files are looked up by name, ignoring case.
+    """
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        self.buffer = memoryview(w3d_struct.map_file(filepath))
+
+        # lower case name -> (name, offset, size)
+        self.files: Dict[str, Tuple[str, int, int]] = {}
+
+        try:
+            magic, table, names, reserved = header.unpack_from(self.buffer)
+            if magic != b'MIX1':
+                raise w3d_struct.ParseError('Not a MIX archive: ' + filepath)
+
+            n = count.unpack_from(self.buffer, table)[0]
+            entries = [
+                file_entry.unpack_from(self.buffer, table + count.size + i * file_entry.size)
+                for i in range(n)
+            ]
+
+            offset = names + count.size
+            if count.unpack_from(self.buffer, names)[0] != n:
+                raise w3d_struct.ParseError('MIX names table doesn\'t match its file table: ' + filepath)
+
+            for crc, start, size in entries:
+                length = self.buffer[offset]
+                name = w3d_struct.b2s(self.buffer[offset + 1:offset + 1 + length])
+                offset += 1 + length
+
+                if start + size > len(self.buffer):
+                    raise w3d_struct.ParseError('MIX file out of the archive: ' + name)
+                self.files.setdefault(name.replace('\\', '/').lower(), (name, start, size))
+        except (struct.error, IndexError):
+            raise w3d_struct.ParseError('Truncated MIX archive: ' + filepath)
+
+    def names(self) -> List[str]:
+        return [f[0] for f in self.files.values()]
+
+    def find(self, name: str) -> Optional[str]:
+        """Name of the file name (any case) as the archive has it. Archives
+        are mostly flat, so 'mytex/gdi_base.dds' is also found as
+        'gdi_base.dds'.
+        """
+        name = name.replace('\\', '/').lower()
+        f = self.files.get(name) or self.files.get(name.rsplit('/', 1)[-1])
+        return None if f is None else f[0]
+
+    def open(self, name: str) -> Optional[memoryview]:
+        """Contents of the file name, a view of the archive, None if there
+        is no such file.
+        """
+        f = self.files.get(name.replace('\\', '/').lower())
+        if f is None:
+            return None
+        return self.buffer[f[1]:f[1] + f[2]]
@@ -0,0 +1,201 @@
+"""Finds the files a w3d file refers to (dependencies, textures) in the
+search directories of an import.
+
+Every directory is listed once into a map from lower case name to name,
+so a lookup doesn't touch the disk and doesn't care about case, like the
+game, along with the archives in it. A listing is read again when the directory's mtime changes; the
+mtime itself is only checked again after recheck_interval seconds.
+
+MIX archives (see w3d_mix) in a search directory are searched too, after
+the directory's own files, and a search path can be an archive. Files
+found in an archive get a path under the archive's
+('data/always.dat/rock.dds'): buffer() returns their contents.
+"""
+import os
+import re
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from . import w3d_mix, w3d_struct
+
+# Seconds a directory listing is used before its mtime is checked again
+recheck_interval = 1.0
+
+# Extensions of the files in a search directory that may be archives
+archive_extensions = ('.mix', '.dat')
+
+# directory -> (mtime, time it was checked,
+#               (lower case name -> name, names of the archives in it))
+directories: Dict[str, Tuple[Optional[int], float, Any]] = {}
+
+# archive -> (mtime, time it was checked, MixArchive or None)
+archives: Dict[str, Tuple[Optional[int], float, Any]] = {}
+
+# path of a file found in an archive -> archive, name in the archive
+members: Dict[str, Tuple[w3d_mix.MixArchive, str]] = {}
+
+# Aggregates are loaded from several threads
+lock = threading.Lock()
+
+def refresh(table: dict, path: str, read: Callable[[str], Any]):
+    """read(path), kept in table until the mtime of path changes. None if
+    path doesn't exist.
+    """
+    now = time.monotonic()
+    with lock:
+        entry = table.get(path)
+    if entry is not None and now - entry[1] < recheck_interval:
+        return entry[2]
+
+    try:
+        mtime: Optional[int] = os.stat(path).st_mtime_ns
+    except OSError:
+        mtime = None
+
+    if entry is not None and entry[0] == mtime:
+        value = entry[2]
+    else:
+        value = None if mtime is None else read(path)
+
+    with lock:
+        table[path] = (mtime, now, value)
+    return value
+
+def read_listing(directory: str) -> Tuple[Dict[str, str], List[str]]:
+    names: Dict[str, str] = {}
+    try:
+        with os.scandir(directory) as it:
+            for e in it:
+                names.setdefault(e.name.lower(), e.name)
+    except OSError:
+        pass
+
+    # In the order search() looks into them
+    mixes = [names[lower] for lower in sorted(names) if os.path.splitext(lower)[1] in archive_extensions]
+    return names, mixes
+
+def read_archive(filepath: str) -> Optional[w3d_mix.MixArchive]:
+    if not w3d_mix.is_archive(filepath):
+        return None
+    try:
+        return w3d_mix.MixArchive(filepath)
+    except w3d_struct.ParseError as e:
+        print(str(e))
+        return None
+
+def listing(directory: str) -> Dict[str, str]:
+    """Lower case name -> name of the entries of directory (empty if it
+    doesn't exist).
+    """
+    entry = refresh(directories, directory, read_listing)
+    return {} if entry is None else entry[0]
+
+def archive_names(directory: str) -> List[str]:
+    """Names of the entries of directory that may be archives, sorted.
+    """
+    entry = refresh(directories, directory, read_listing)
+    return [] if entry is None else entry[1]
+
+def archive(filepath: str) -> Optional[w3d_mix.MixArchive]:
+    """The MIX archive filepath, None if it isn't one.
+    """
+    return refresh(archives, filepath, read_archive)
+
+def resolve(directory: str, name: str) -> Optional[str]:
+    """Path of name (which may have directories in it, 'mytex/gdi_base.dds')
+    under directory, whatever its case. None if there is no such file.
+    """
+    directory = os.path.normpath(directory)
+    for part in re.split(r'[\\/]', name):
+        if part in ('', '.'):
+            continue
+        if part == '..':
+            directory = os.path.dirname(directory)
+            continue
+
+        real = listing(directory).get(part.lower())
+        if real is None:
+            return None
+        directory = os.path.join(directory, real)
+
+    return directory
+
+def resolve_archive(mix: w3d_mix.MixArchive, name: str) -> Optional[str]:
+    real = mix.find(name)
+    if real is None:
+        return None
+
+    filepath = os.path.join(mix.filepath, real)
+    with lock:
+        members[filepath] = (mix, real)
+    return filepath
+
+def search(path: str, name: str) -> Optional[str]:
+    """Path of name in the search path path: a directory and the archives
+    in it, or an archive.
+    """
+    path = os.path.normpath(path)
+    if os.path.splitext(path)[1].lower() in archive_extensions:
+        mix = archive(path)
+        if mix is not None:
+            return resolve_archive(mix, name)
+
+    filepath = resolve(path, name)
+    if filepath is not None:
+        return filepath
+
+    for real in archive_names(path):
+        mix = archive(os.path.join(path, real))
+        if mix is not None:
+            filepath = resolve_archive(mix, name)
+            if filepath is not None:
+                return filepath
+
+    return None
+
+def find(paths: List[str], name: str) -> Optional[str]:
+    """Path of name in the first of paths that has it, None if none does.
+    """
+    for path in paths:
+        filepath = search(path, name)
+        if filepath is not None:
+            return filepath
+
+    return None
+
+def find_texture(paths: List[str], name: str) -> Tuple[Optional[str], str]:
+    """Like find, but a texture that isn't there may have been converted to
+    .dds ('tex.tga' can be 'tex.dds'), which is tried in each path too.
+    Returns the path and the name that was found.
+    """
+    ddsname = os.path.splitext(name)[0] + '.dds'
+    for path in paths:
+        for n in (name, ddsname):
+            filepath = search(path, n)
+            if filepath is not None:
+                return filepath, n
+
+    return None, name
+
+def buffer(filepath: str) -> Optional[memoryview]:
+    """Contents of a file find() found in an archive, None for files on
+    disk.
+    """
+    with lock:
+        member = members.get(filepath)
+    if member is None:
+        return None
+    return member[0].open(member[1])
+
+def getsize(filepath: str) -> int:
+    data = buffer(filepath)
+    return os.path.getsize(filepath) if data is None else len(data)
+
+def clear():
+    """Forgets every listing and archive, so they are read again.
+    """
+    with lock:
+        directories.clear()
+        archives.clear()
+        members.clear()
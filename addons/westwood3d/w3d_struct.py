@@ -1,19 +1,35 @@
 from __future__ import annotations
 
+import bisect
+import ctypes
+import fnmatch
+import itertools
+import math
 import mmap
+import os
+import re
 import struct
+import tempfile
 import typing
 
-from math import ceil
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from math import ceil, prod
+from multiprocessing import resource_tracker, shared_memory
 from typing import cast, Any, BinaryIO, Dict, List, Optional, Tuple
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 def b2s(by: bytes) -> str:
-    return by.split(b'\0')[0].decode('utf-8')
+    return bytes(by).split(b'\0')[0].decode('utf-8')
 
-def s2b(s: str, len=None) -> bytes:
+def s2b(s: str, length=None) -> bytes:
     by = s.encode('utf-8')
-    if len is not None and len(by) >= len:
-        by = by[:len - 1]
+    if length is not None and len(by) >= length:
+        by = by[:length - 1]
     
     return by + b'\0'
 
@@ -173,98 +189,425 @@ w3d_keys = {
 
 w3d_save_keys = {v:k for k, v in w3d_keys.items()}
 
+# Precompiled layouts of the fixed size chunks, and of the elements of the
+# chunks that are arrays. Always little-endian with standard sizes so the
+# files are the same on every platform.
+codecs = {
+    'header': struct.Struct('<II'),
+
+    'mesh_header3': struct.Struct('<II16s16sIIIIiIIII3f3f3ff'),
+    'vertices': struct.Struct('<3f'),
+    'vertex_normals': struct.Struct('<3f'),
+    'vertex_influences': struct.Struct('<H6B'),
+    'triangles': struct.Struct('<3II3ff'),
+    'vertex_shade_indices': struct.Struct('<I'),
+
+    'material_info': struct.Struct('<4I'),
+    'shaders': struct.Struct('<16B'),
+    'vertex_material_info': struct.Struct('<I4B4B4B4Bfff'),
+    'texture_info': struct.Struct('<2HIf'),
+    'vertex_material_ids': struct.Struct('<I'),
+    'shader_ids': struct.Struct('<I'),
+    'dcg': struct.Struct('<4B'),
+    'texture_ids': struct.Struct('<I'),
+    'stage_texcoords': struct.Struct('<2f'),
+
+    'aabtree_header': struct.Struct('<2I24x'),
+
+    'hierarchy_header': struct.Struct('<I16sI3f'),
+    'pivots': struct.Struct('<16sI3f3f4f'),
+
+    'animation_header': struct.Struct('<I16s16s2I'),
+    'animation_channel': struct.Struct('<6H'),
+    'bit_channel': struct.Struct('<4HB'),
+
+    'compressed_animation_header': struct.Struct('<I16s16sI2H'),
+    'timecoded_animation_channel': struct.Struct('<IH2B'),
+    'adaptivedelta_animation_channel': struct.Struct('<IH2Bf'),
+    'adaptivedelta_block': struct.Struct('<B8s'),
+
+    'light_info': struct.Struct('<2I4B4B4Bf'),
+    'light_transform': struct.Struct('<12f'),
+
+    'aggregate_header': struct.Struct('<I16s'),
+    'aggregate_info': struct.Struct('<32sI'),
+    'aggregate_subobject': struct.Struct('<32s32s'),
+    'aggregate_class_info': struct.Struct('<II3I'),
+
+    'hlod_header': struct.Struct('<II16s16s'),
+    'hlod_sub_object_array_header': struct.Struct('<If'),
+    'hlod_sub_object': struct.Struct('<I32s'),
+
+    'box': struct.Struct('<II32s4B3f3f'),
+    'sphere': struct.Struct('<II32s4B3f3f'),
+    'ring': struct.Struct('<II32s4B3f3f'),
+}
+
+class record():
+    """One element of an array chunk (a pivot, a shader...).
+
+    Fields are slots, so a record is a fraction of the size of the dict it
+    replaces, but it is still read and written like one: p['Name']. Records
+    compare and hash by value.
+    """
+    __slots__ = ()
+
+    def __init__(self, *values, **fields):
+        fields.update(zip(self.__slots__, values))
+        for key in self.__slots__:
+            setattr(self, key, fields.pop(key, None))
+        if fields:
+            raise TypeError('unknown fields: ' + ', '.join(fields))
+
+    def __getitem__(self, key: str):
+        return getattr(self, key)
+
+    def __setitem__(self, key: str, value):
+        setattr(self, key, value)
+
+    def keys(self) -> Tuple[str, ...]:
+        return self.__slots__
+
+    def values(self) -> tuple:
+        return tuple(getattr(self, k) for k in self.__slots__)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.values() == other.values()
+
+    def __hash__(self):
+        return hash(self.values())
+
+    def __reduce__(self):
+        # Pickled as the values alone, load_many sends a lot of them
+        return type(self), self.values()
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join(
+            '%s=%r' % (k, getattr(self, k)) for k in self.__slots__
+        ))
+
+class record_triangle(record):
+    __slots__ = ('Vindex', 'Attributes', 'Normal', 'Dist')
+
+class record_shader(record):
+    __slots__ = (
+        'DepthCompare', 'DepthMask', 'DestBlend', 'PriGradient', 'SecGradient',
+        'SrcBlend', 'Texturing', 'DetailColorFunc', 'DetailAlphaFunc',
+        'AlphaTest', 'PostDetailColorFunc', 'PostDetailAlphaFunc',
+    )
+
+class record_pivot(record):
+    __slots__ = ('Name', 'ParentIdx', 'Translation', 'EulerAngles', 'Rotation')
+
+class record_subobject(record):
+    __slots__ = ('SubobjectName', 'BoneName')
+
 class node():
     children: List[node]
     binary: Optional[bytes]
     size: int
 
+    # Every subclass declares its own fields in __slots__ so that nodes don't
+    # carry a __dict__; there can be hundreds of thousands of them.
+    __slots__ = ('children', 'binary', 'size', '_lazy', '_source', '_index', '_index_rec')
+
+    # Lower case chunk name, 'mesh' for node_mesh
+    chunk_type = ''
+
+    # Whether the payload is made of chunks. save() sets the container bit
+    # from this; older versions set it on every chunk, so the bit read from
+    # a file can't be trusted.
+    container = False
+
+    # Chunk id written by save, looked up from chunk_type unless the class
+    # sets it
+    chunk_id: Optional[int] = None
+
+    # Public slots of the class and its bases, see fields()
+    slot_fields: Tuple[str, ...] = ('children', 'binary', 'size')
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.chunk_type = cls.__name__[5:]
+        if 'chunk_id' not in cls.__dict__:
+            cls.chunk_id = w3d_save_keys.get(cls.chunk_type.upper())
+        cls.slot_fields += tuple(k for k in cls.__dict__.get('__slots__', ()) if not k.startswith('_'))
+
     def __init__(self):
         self.children = []
         self.binary = None
         self.size = 0
 
+        # (reader, offset, size) of the payload while it hasn't been decoded
+        self._lazy = None
+
+        # (header offset, payload size) of the chunk in the file it was read
+        # from, for files opened with edit(). None once it has been edited.
+        self._source = None
+
+        # type -> children and type -> all descendants (in findRec order),
+        # built on the first lookup
+        self._index = None
+        self._index_rec = None
+
+    def __getattr__(self, name: str):
+        # Only reached for attributes that aren't set, which is the state of
+        # a lazily loaded node until its payload has been decoded.
+        if name == '_lazy' or name.startswith('__') or self._lazy is None:
+            raise AttributeError(name)
+
+        self.decode()
+        return getattr(self, name)
+
+    def __reduce__(self):
+        # Pickled as the class and the values of the public slots, which is
+        # smaller and much quicker to load than the default (load_many
+        # pickles whole trees). Bit i of unset is set if slot i is.
+        self.decode()
+        values = []
+        unset = 0
+        for i, key in enumerate(self.slot_fields):
+            try:
+                values.append(getattr(self, key))
+            except AttributeError:
+                values.append(None)
+                unset |= 1 << i
+        return rebuild_node, (type(self), tuple(values), unset, getattr(self, '__dict__', None))
+
+    def decode(self):
+        """Decodes the payload of a lazily loaded node.
+        Does nothing if the node has already been decoded. If decoding
+        fails the node stays lazy, and raises again the next time.
+        """
+        lazy = self._lazy
+        if lazy is None:
+            return
+
+        reader, offset, size = lazy
+        source = self._source
+        self.__init__()
+        self._source = source
+        try:
+            self.read(reader.at(offset), size)
+        except BaseException:
+            self._lazy = lazy
+            raise
+
+    def resolve(self):
+        """Decodes this node and all of its children.
+        """
+        self.decode()
+        for c in self.children:
+            c.resolve()
+
     def read(self, file: BinaryIO, size):
         self.children = parse_nodes(file, size)
 
+    def touch(self):
+        """Marks the node as edited. When the file was opened with edit(),
+        save() then encodes it again instead of copying the original chunk.
+
+        Call it before changing fields: it decodes the node, which would
+        overwrite anything set on a node that is still lazy. Adding or
+        removing children is noticed without it.
+        """
+        self.decode()
+        self._source = None
+
     def write(self, file: BinaryIO):
-        file.write(struct.pack('LL',
-            w3d_save_keys[self.type().upper()],
-            self.size | 0x80000000
-        ))
+        """Writes the chunk, as encoded by pack(), to file.
+        """
+        buffer = bytearray(8 + self.size)
+        self.write_into(buffer, 0)
+        file.write(buffer)
+
+    def write_into(self, buffer: bytearray, offset: int) -> int:
+        """Copies the chunk, as encoded by pack(), into buffer at offset.
+        Returns the offset of the end of the chunk.
+        """
+        codecs['header'].pack_into(
+            buffer, offset,
+            self.chunk_id,
+            (self.size | 0x80000000) if self.container else self.size
+        )
+        offset += 8
 
         if self.binary is not None:
-            file.write(self.binary)
-        
+            end = offset + len(self.binary)
+            buffer[offset:end] = self.binary
+            offset = end
+
         for c in self.children:
-            c.write(file)
+            offset = c.write_into(buffer, offset)
+
+        return offset
 
     def pack(self):
+        """Encodes the payload into binary and sets size, which includes
+        the children. Containers only add up the sizes of their children.
+        """
+        self.size = 0
         for c in self.children:
             c.pack()
             self.size += 8 + c.size
 
     def type(self) -> str:
-        return self.__class__.__name__[5:]
+        return self.chunk_type
 
     def log(self, max, indent=0):
+        self.decode()
         print(('\t'*indent) + self.type())
         
         indent += 1
         
-        for key, value in self.__dict__.items():
-            if key != 'children':
-                print(('\t'*indent) + key + ' = ' + str(value))
+        for key in self.fields():
+            if key != 'children' and hasattr(self, key):
+                print(('\t'*indent) + key + ' = ' + str(getattr(self, key)))
         
         if indent < max:
             for n in self.children:
                 n.log(max, indent)
 
+    def fields(self) -> List[str]:
+        """Names of the attributes a node can have, set or not (all the
+        slots, and __dict__ for node_raw), without the private ones.
+        """
+        keys = list(self.slot_fields)
+        keys += [k for k in getattr(self, '__dict__', ()) if not k.startswith('_')]
+        return keys
+
+    def walk(self):
+        """Iterates over this node and all its descendants, in file order.
+        """
+        stack = [self]
+        while stack:
+            n = stack.pop()
+            yield n
+            stack.extend(reversed(n.children))
+
+    def clone(self) -> node:
+        """Copies this node and its descendants, so that a tree can be
+        changed without changing the original. The fields themselves
+        (arrays, records, strings...) are shared, and nodes that haven't
+        been decoded yet are copied as they are, still lazy.
+        """
+        cls = type(self)
+        n = cls.__new__(cls)
+        n._lazy = self._lazy
+        n._source = self._source
+        if n._lazy is not None:
+            # Nothing else is set until it is decoded
+            return n
+
+        for key in self.slot_fields:
+            try:
+                setattr(n, key, getattr(self, key))
+            except AttributeError:
+                pass
+        n._index = None
+        n._index_rec = None
+
+        attributes = getattr(self, '__dict__', None)
+        if attributes:
+            n.__dict__.update(attributes)
+
+        n.children = [c.clone() for c in self.children]
+        return n
+
     def add(self, type: str) -> node:
         c = globals()['node_' + type]()
         self.children.append(c)
+        self.reindex()
         return c
 
+    def remove(self, child: node):
+        self.children.remove(child)
+        self.reindex()
+
+    def extend(self, children: List[node]):
+        self.children.extend(children)
+        self.reindex()
+
+    def reindex(self):
+        """Drops the lookup indices of this node.
+
+        add, remove and extend do this already. Edit children through them,
+        or call this after changing the children list (or a subtree that has
+        been searched with getRec/findRec) directly.
+        """
+        self._index = None
+        self._index_rec = None
+
+    def index(self) -> Dict[str, List[node]]:
+        if self._index is None:
+            index = {}
+            for i in self.children:
+                index.setdefault(i.chunk_type, []).append(i)
+            self._index = index
+
+        return self._index
+
+    def indexRec(self) -> Dict[str, List[node]]:
+        if self._index_rec is None:
+            index = {}
+            for i in self.children:
+                index.setdefault(i.chunk_type, []).append(i)
+                for name, l in i.indexRec().items():
+                    index.setdefault(name, []).extend(l)
+            self._index_rec = index
+
+        return self._index_rec
+
     def get(self, name: str) -> Optional[node]:
-        for i in self.children:
-            if i.type() == name:
-                return i
-        return None
+        l = self.index().get(name)
+        return l[0] if l else None
 
     def getRec(self, name: str) -> Optional[node]:
-        for i in self.children:
-            if i.type() == name:
-                return i
-            res = i.getRec(name)
-            if res != None:
-                return res
-
-        return None
+        l = self.indexRec().get(name)
+        return l[0] if l else None
 
     def find(self, name: str) -> List[node]:
-        l = []
-        for i in self.children:
-            if i.type() == name:
-                l.append(i)
-        
-        return l
+        return list(self.index().get(name, ()))
 
     def findRec(self, name: str) -> List[node]:
         """Recursively searches through all children for records of type name.
         """
-        l = []
+        return list(self.indexRec().get(name, ()))
 
-        for i in self.children:
-            if i.type() == name:
-                l.append(i)
-            l.extend(i.findRec(name))
-        
-        return l
+def rebuild_node(cls, values: tuple, unset=0, attributes=None) -> node:
+    """Unpickles a node, see node.__reduce__.
+    """
+    n = cls.__new__(cls)
+    n._lazy = None
+    n._source = None
+    n._index = None
+    n._index_rec = None
+    for key, value in zip(cls.slot_fields, values):
+        setattr(n, key, value)
+    if unset:
+        for i, key in enumerate(cls.slot_fields):
+            if unset >> i & 1:
+                delattr(n, key)
+    if attributes:
+        n.__dict__.update(attributes)
+    return n
 
 class node_mesh(node):
+    # Filled in by the importer
+    __slots__ = ('Materials', 'Mindex', 'Vorigin', 'blender_object')
+    container = True
+
     def read(self, file, size):
         self.children = parse_nodes(file, size)
 
 class node_mesh_header3(node):
+    __slots__ = (
+        'Version', 'Attributes', 'MeshName', 'ContainerName', 'NumTris',
+        'NumVertices', 'NumMaterials', 'NumDamageStages', 'SortLevel',
+        'PrelitVersion', 'FutureCounts', 'VertexChannels', 'FaceChannels',
+        'Min', 'Max', 'SphCenter', 'SphRadius',
+    )
+
     def __init__(self):
         super(node_mesh_header3, self).__init__()
         self.Version = ver(4,2)
@@ -285,7 +628,7 @@ class node_mesh_header3(node):
         self.SphCenter = (0,0,0)
         self.SphRadius = 0
     def read(self, file, size):
-        data = read_struct(file, 'LL16s16sLLLLlLLLL3f3f3ff')
+        data = read_struct(file, codecs['mesh_header3'])
         self.Version = data[0]
         self.Attributes = data[1]
         self.MeshName = b2s(data[2])
@@ -304,7 +647,7 @@ class node_mesh_header3(node):
         self.SphCenter = (data[19], data[20], data[21])
         self.SphRadius = data[22]
     def pack(self):
-        self.binary = struct.pack('LL16s16sLLLLlLLLL3f3f3ff',
+        self.binary = codecs['mesh_header3'].pack(
             self.Version,
             self.Attributes,
             s2b(self.MeshName, 16),
@@ -323,9 +666,11 @@ class node_mesh_header3(node):
             self.SphCenter[0], self.SphCenter[1], self.SphCenter[2],
             self.SphRadius,
         )
-        self.size += struct.calcsize('LL16s16sLLLLlLLLL3f3f3ff')
+        self.size = codecs['mesh_header3'].size
 
 class node_mesh_user_text(node):
+    __slots__ = ('text',)
+
     def __init__(self):
         super(node_mesh_user_text, self).__init__()
         self.text = ""
@@ -335,113 +680,121 @@ class node_mesh_user_text(node):
 
     def pack(self):
         self.binary = s2b(self.text)
+        self.size = len(self.binary)
 
 class node_vertices(node):
     vertices: List[Tuple[float, float, float]]
 
+    __slots__ = ('vertices',)
+
     def __init__(self):
         super(node_vertices, self).__init__()
         self.vertices = []
     def read(self, file, size):
-        while size > 0:
-            data = read_struct(file, '3f')
-            self.vertices.append((data[0], data[1], data[2]))
-            size -= struct.calcsize('3f')
+        self.vertices = read_array(file, size, codecs['vertices'], '<f4')
     def pack(self):
-        self.binary = b''
-        for v in self.vertices:
-            self.binary += struct.pack('3f',
-                v[0], v[1], v[2]
-            )
-            self.size += struct.calcsize('3f')
+        self.binary = pack_array(self.vertices, codecs['vertices'], '<f4')
+        self.size = len(self.binary)
 
 class node_vertex_normals(node):
+    __slots__ = ('normals',)
+
     def __init__(self):
         super(node_vertex_normals, self).__init__()
         self.normals = []
     def read(self, file, size):
-        while size > 0:
-            data = read_struct(file, '3f')
-            self.normals.append((data[0], data[1], data[2]))
-            size -= struct.calcsize('3f')
+        self.normals = read_array(file, size, codecs['vertex_normals'], '<f4')
     def pack(self):
-        self.binary = b''
-        for v in self.normals:
-            self.binary += struct.pack('3f',
-                v[0], v[1], v[2]
-            )
-            self.size += struct.calcsize('3f')
+        self.binary = pack_array(self.normals, codecs['vertex_normals'], '<f4')
+        self.size = len(self.binary)
 
 class node_vertex_shade_indices(node):
+    __slots__ = ('ids',)
+
     def __init__(self):
         super(node_vertex_shade_indices, self).__init__()
         self.ids = []
     def read(self, file, size):
-        while size > 0:
-            data = read_struct(file, 'L')
-            self.ids.append(data[0])
-            size -= struct.calcsize('L')
+        self.ids = read_array(file, size, codecs['vertex_shade_indices'], '<u4')
     def pack(self):
-        self.binary = b''
-        for i in self.ids:
-            self.binary += struct.pack('L',
-                i
-            )
-            self.size += struct.calcsize('L')
+        self.binary = pack_array(self.ids, codecs['vertex_shade_indices'], '<u4')
+        self.size = len(self.binary)
 
 class node_vertex_influences(node):
+    __slots__ = ('influences',)
+
     def __init__(self):
         super(node_vertex_influences, self).__init__()
         self.influences = []
     def read(self, file, size):
-        while size > 0:
-            data = read_struct(file, 'H6B')
+        for data in read_elements(file, size, codecs['vertex_influences']):
             self.influences.append(data[0])
-            size -= struct.calcsize('H6B')
     def pack(self):
-        self.binary = b''
-        for i in self.influences:
-            self.binary += struct.pack('H6B',
-                i, 0, 0, 0, 0, 0, 0
-            )
-            self.size += struct.calcsize('H6B')
+        if np is not None:
+            # Bone index followed by 6 bytes of padding
+            data = np.zeros((len(self.influences), 4), dtype='<u2')
+            data[:, 0] = self.influences
+            self.binary = data.tobytes()
+        else:
+            codec = codecs['vertex_influences']
+            self.binary = b''.join(codec.pack(i, 0, 0, 0, 0, 0, 0) for i in self.influences)
+        self.size = len(self.binary)
 
 class node_triangles(node):
-    triangles: List[Dict[str, Any]]
+    triangles: List[record_triangle]
+
+    __slots__ = ('triangles',)
 
     def __init__(self):
         super(node_triangles, self).__init__()
         self.triangles = []
     def read(self, file, size):
-        while size > 0:
-            data = read_struct(file, '3LL3ff')
-            self.triangles.append({
-                'Vindex': (data[0], data[1], data[2]),
-                'Attributes': data[3],
-                'Normal': (data[4],data[5],data[6]),
-                'Dist': data[7],
-            })
-            size -= struct.calcsize('3LL3ff')
+        codec = codecs['triangles']
+
+        if np is not None:
+            # Record array, rows still index like the records below: t['Vindex']
+            count = size // codec.size
+            self.triangles = np.frombuffer(file.read(size), dtype=triangle_dtype, count=count)
+            return
+
+        self.triangles = [
+            record_triangle(data[0:3], data[3], data[4:7], data[7])
+            for data in read_elements(file, size, codec)
+        ]
     def pack(self):
-        self.binary = b''
-        for t in self.triangles:
-            self.binary += struct.pack('3LL3ff',
+        if np is not None:
+            triangles = self.triangles
+            if not isinstance(triangles, np.ndarray):
+                triangles = np.array([
+                    (t['Vindex'], t['Attributes'], t['Normal'], t['Dist']) for t in triangles
+                ], dtype=triangle_dtype)
+            self.binary = triangles.astype(triangle_dtype, copy=False).tobytes()
+        else:
+            self.binary = b''.join(codecs['triangles'].pack(
                 t['Vindex'][0], t['Vindex'][1], t['Vindex'][2],
                 t['Attributes'],
                 t['Normal'][0], t['Normal'][1], t['Normal'][2],
                 t['Dist']
-            )
-            self.size += struct.calcsize('3LL3ff')
+            ) for t in self.triangles)
+        self.size = len(self.binary)
 
 class node_vertex_materials(node):
+    __slots__ = ()
+    container = True
+
     def read(self, file, size):
         self.children = parse_nodes(file, size)
 
 class node_vertex_material(node):
+    __slots__ = ()
+    container = True
+
     def read(self, file, size):
         self.children = parse_nodes(file, size)
 
 class node_vertex_material_name(node):
+    __slots__ = ('name',)
+
     def __init__(self):
         super(node_vertex_material_name, self).__init__()
         self.name = 'UNTITLED'
@@ -452,6 +805,11 @@ class node_vertex_material_name(node):
         self.size = len(self.binary)
 
 class node_vertex_material_info(node):
+    __slots__ = (
+        'Attributes', 'Ambient', 'Diffuse', 'Specular', 'Emissive', 'Shininess',
+        'Opacity', 'Translucency', 'Mapping0', 'Mapping1',
+    )
+
     def __init__(self):
         super(node_vertex_material_info, self).__init__()
         self.Attributes = 0
@@ -463,7 +821,7 @@ class node_vertex_material_info(node):
         self.Opacity = 1.0
         self.Translucency = 0
     def read(self, file, size):
-        data = read_struct(file, 'L4B4B4B4Bfff')
+        data = read_struct(file, codecs['vertex_material_info'])
         self.Attributes = data[0]
         self.Ambient = (data[1], data[2], data[3])
         self.Diffuse = (data[5], data[6], data[7])
@@ -475,7 +833,7 @@ class node_vertex_material_info(node):
         self.Mapping0 = data[0] >> 16 & 0xFF
         self.Mapping1 = data[0] >> 8 & 0xFF
     def pack(self):
-        self.binary = struct.pack('L4B4B4B4Bfff',
+        self.binary = codecs['vertex_material_info'].pack(
             self.Attributes,
             self.Ambient[0], self.Ambient[1], self.Ambient[2], 0,
             self.Diffuse[0], self.Diffuse[1], self.Diffuse[2], 0,
@@ -485,28 +843,30 @@ class node_vertex_material_info(node):
             self.Opacity,
             self.Translucency
         )
-        self.size += struct.calcsize('L4B4B4B4Bfff')
+        self.size = codecs['vertex_material_info'].size
 
 class node_dcg(node):
-    def read(self, file, size):
+    __slots__ = ('dcg',)
+
+    def __init__(self):
+        super(node_dcg, self).__init__()
         self.dcg = []
-        while size > 0:
-            data = read_struct(file, '4B')
-            self.dcg.append((data[0], data[1], data[2], data[3]))
-            size -= struct.calcsize('4B')
+    def read(self, file, size):
+        self.dcg = read_array(file, size, codecs['dcg'], 'u1')
     def pack(self):
-        self.binary = b''
-        for c in self.dcg:
-            self.binary += struct.pack('4B',
-                c[0], c[1], c[2], c[3]
-            )
-            self.size += struct.calcsize('4B')
+        self.binary = pack_array(self.dcg, codecs['dcg'], 'u1')
+        self.size = len(self.binary)
     
 class node_prelit_lightmap_multi_pass(node):
+    __slots__ = ()
+    container = True
+
     def read(self, file, size):
         self.children = parse_nodes(file, size)
     
 class node_material_info(node):
+    __slots__ = ('PassCount', 'VertexMaterialCount', 'ShaderCount', 'TextureCount')
+
     def __init__(self):
         super(node_material_info, self).__init__()
         self.PassCount = 0
@@ -514,90 +874,81 @@ class node_material_info(node):
         self.ShaderCount = 0
         self.TextureCount = 0
     def read(self, file, size):
-        data = read_struct(file, 'LLLL')
+        data = read_struct(file, codecs['material_info'])
         self.PassCount = data[0]
         self.VertexMaterialCount = data[1]
         self.ShaderCount = data[2]
         self.TextureCount = data[3]
     def pack(self):
-        self.binary = struct.pack('LLLL',
+        self.binary = codecs['material_info'].pack(
             self.PassCount,
             self.VertexMaterialCount,
             self.ShaderCount,
             self.TextureCount
         )
-        self.size += struct.calcsize('LLLL')
+        self.size = codecs['material_info'].size
     
 class node_material_pass(node):
+    __slots__ = ()
+    container = True
+
     def read(self, file, size):
         self.children = parse_nodes(file, size)
 
 class node_vertex_material_ids(node):
     ids: List[int]
 
+    __slots__ = ('ids',)
+
     def __init__(self):
         super(node_vertex_material_ids, self).__init__()
         self.ids = []
     def read(self, file, size):
-        while size > 0:
-            data = read_struct(file, 'L')
-            self.ids.append(data[0])
-            size -= struct.calcsize('L')
+        self.ids = read_array(file, size, codecs['vertex_material_ids'], '<u4')
     def pack(self):
-        self.binary = b''
-        for i in self.ids:
-            self.binary += struct.pack('L',
-                i
-            )
-            self.size += struct.calcsize('L')
+        self.binary = pack_array(self.ids, codecs['vertex_material_ids'], '<u4')
+        self.size = len(self.binary)
 
 class node_shader_ids(node):
     ids: List[int]
 
+    __slots__ = ('ids',)
+
     def __init__(self):
         super(node_shader_ids, self).__init__()
         self.ids = []
     def read(self, file, size):
-        while size > 0:
-            data = read_struct(file, 'L')
-            self.ids.append(data[0])
-            size -= struct.calcsize('L')
+        self.ids = read_array(file, size, codecs['shader_ids'], '<u4')
     def pack(self):
-        self.binary = b''
-        for i in self.ids:
-            self.binary += struct.pack('L',
-                i
-            )
-            self.size += struct.calcsize('L')
+        self.binary = pack_array(self.ids, codecs['shader_ids'], '<u4')
+        self.size = len(self.binary)
 
 class node_shaders(node):
+    __slots__ = ('shaders',)
+
     def __init__(self):
         super(node_shaders, self).__init__()
         self.shaders = []
     def read(self, file, size):
-        while size > 0:
-            data = read_struct(file, '16B')
-            self.shaders.append({
-                'SrcBlend': data[7],
-                'DestBlend': data[3],
-                'DepthMask': data[1],
-                'AlphaTest': data[12],
-                
-                'PriGradient': data[5],
-                'SecGradient': data[6],
-                'DepthCompare': data[0],
-                'DetailColorFunc': data[9],
-                'DetailAlphaFunc': data[10],            
-                
-                'Texturing': data[8],
-                'PostDetailColorFunc': data[13],
-                'PostDetailAlphaFunc': data[14]
-            })
-            size -= struct.calcsize('16B')
+        for data in read_elements(file, size, codecs['shaders']):
+            self.shaders.append(record_shader(
+                SrcBlend=data[7],
+                DestBlend=data[3],
+                DepthMask=data[1],
+                AlphaTest=data[12],
+
+                PriGradient=data[5],
+                SecGradient=data[6],
+                DepthCompare=data[0],
+                DetailColorFunc=data[9],
+                DetailAlphaFunc=data[10],
+
+                Texturing=data[8],
+                PostDetailColorFunc=data[13],
+                PostDetailAlphaFunc=data[14]
+            ))
     def pack(self):
-        self.binary = b''
-        for s in self.shaders:
-            self.binary += struct.pack('16B',
+        self.binary = b''.join(codecs['shaders'].pack(
                 s['DepthCompare'],
                 s['DepthMask'],
                 0,
@@ -614,64 +965,71 @@ class node_shaders(node):
                 s['PostDetailColorFunc'],
                 s['PostDetailAlphaFunc'],
                 0
-            )
-            self.size += struct.calcsize('16B')
+            ) for s in self.shaders)
+        self.size = len(self.binary)
 
 class node_texture_stage(node):
+    __slots__ = ()
+    container = True
+
     def read(self, file, size):
         self.children = parse_nodes(file, size)
 
 class node_texture_ids(node):
+    __slots__ = ('ids',)
+
     def __init__(self):
         super(node_texture_ids, self).__init__()
         self.ids = []
     def read(self, file, size):
-        while size > 0:
-            data = read_struct(file, 'L')
-            self.ids.append(data[0])
-            size -= struct.calcsize('L')
+        self.ids = read_array(file, size, codecs['texture_ids'], '<u4')
     def pack(self):
-        self.binary = b''
-        for i in self.ids:
-            self.binary += struct.pack('L',
-                i
-            )
-            self.size += struct.calcsize('L')
+        self.binary = pack_array(self.ids, codecs['texture_ids'], '<u4')
+        self.size = len(self.binary)
 
 class node_stage_texcoords(node):
+    __slots__ = ('texcoords',)
+
     def __init__(self):
         super(node_stage_texcoords, self).__init__()
         self.texcoords = []
     def read(self, file, size):
-        while size > 0:
-            data = read_struct(file, '2f')
-            self.texcoords.append((data[0], data[1]))
-            size -= struct.calcsize('2f')
+        self.texcoords = read_array(file, size, codecs['stage_texcoords'], '<f4')
     def pack(self):
-        self.binary = b''
-        for t in self.texcoords:
-            self.binary += struct.pack('2f',
-                t[0], t[1]
-            )
-            self.size += struct.calcsize('2f')
+        self.binary = pack_array(self.texcoords, codecs['stage_texcoords'], '<f4')
+        self.size = len(self.binary)
 
 class node_texture_texcoords(node):
+    __slots__ = ()
+    container = True
+
     def read(self, file, size):
         self.children = parse_nodes(file, size)
 
 class node_textures(node):
+    __slots__ = ()
+    container = True
+
     def read(self, file, size):
         self.children = parse_nodes(file, size)
 
 class node_texture(node):
+    __slots__ = ()
+    container = True
+
     def read(self, file, size):
         self.children = parse_nodes(file, size)
 
 class node_aabtree(node):
+    __slots__ = ()
+    container = True
+
     def read(self, file, size):
         self.children = parse_nodes(file, size)
 
 class node_aabtree_header(node):
+    __slots__ = ('NodeCount', 'PolyCount')
+
     def __init__(self):
         super(node_aabtree_header, self).__init__()
         self.NodeCount = 0
@@ -679,35 +1037,52 @@ class node_aabtree_header(node):
         # Padding 24 bytes
 
     def read(self, file, size):
-        data = read_struct(file, '2I')
+        data = read_struct(file, codecs['aabtree_header'])
         self.NodeCount = data[0]
         self.PolyCount = data[1]
-        file.read(24) # Skip padding
+
+    def pack(self):
+        self.binary = codecs['aabtree_header'].pack(self.NodeCount, self.PolyCount)
+        self.size = codecs['aabtree_header'].size
 
 class node_hierarchy(node):
+    __slots__ = ()
+    container = True
+
     def read(self, file, size):
         self.children = parse_nodes(file, size)
 
 class node_lightscape(node):
+    __slots__ = ()
+    container = True
+
     def read(self, file, size):
         self.children = parse_nodes(file, size)
 
 class node_lightscape_light(node):
+    __slots__ = ()
+    container = True
+
     def read(self, file, size):
         self.children = parse_nodes(file, size)
 
 class node_light(node):
+    __slots__ = ()
+    container = True
+
     def read(self, file, size):
         self.children = parse_nodes(file, size)
 
 class node_light_info(node):
+    __slots__ = ('Attributes', 'Ambient', 'Diffuse', 'Specular', 'Intensity')
+
     def __init__(self):
         super(node_light_info, self).__init__()
 
         self.Attributes = 0
-        self.Ambient = []
-        self.Diffuse = []
-        self.Specular = []
+        self.Ambient = [0, 0, 0, 0]
+        self.Diffuse = [0, 0, 0, 0]
+        self.Specular = [0, 0, 0, 0]
         self.Intensity = 0.0
 
     def read(self, file, size):
@@ -718,7 +1093,7 @@ class node_light_info(node):
         # RGB Diffuse
         # RGB Specular
         # flt Intensity
-        data = read_struct(file, '2I4B4B4Bf')
+        data = read_struct(file, codecs['light_info'])
         self.Attributes = data[0]
         self.Ambient = [data[2], data[3], data[4], data[5]]
         self.Diffuse = [data[6], data[7], data[8], data[9]]
@@ -726,22 +1101,35 @@ class node_light_info(node):
         self.Intensity = data[14]
     
     def pack(self):
-        pass
+        self.binary = codecs['light_info'].pack(
+            self.Attributes, 0,
+            *self.Ambient, *self.Diffuse, *self.Specular,
+            self.Intensity
+        )
+        self.size = codecs['light_info'].size
 
 class node_light_transform(node):
+    __slots__ = ('Transform',)
+
     def __init__(self):
         super(node_light_transform, self).__init__()
 
         self.Transform = []
 
     def read(self, file, size):
-        data = read_struct(file, '12f')
+        data = read_struct(file, codecs['light_transform'])
 
         self.Transform.append((data[0], data[1], data[2], data[3]))
         self.Transform.append((data[4], data[5], data[6], data[7]))
         self.Transform.append((data[8], data[9], data[10], data[11]))
 
+    def pack(self):
+        self.binary = codecs['light_transform'].pack(*[v for row in self.Transform for v in row])
+        self.size = codecs['light_transform'].size
+
 class node_texture_name(node):
+    __slots__ = ('name',)
+
     def __init__(self):
         super(node_texture_name, self).__init__()
         self.name = 'UNTITLED'
@@ -752,6 +1140,8 @@ class node_texture_name(node):
         self.size = len(self.binary)
 
 class node_texture_info(node):
+    __slots__ = ('Attributes', 'AnimType', 'FrameCount', 'FrameRate')
+
     def __init__(self):
         super(node_texture_info, self).__init__()
 
@@ -761,22 +1151,24 @@ class node_texture_info(node):
         self.FrameRate = 0
 
     def read(self, file, size):
-        data = read_struct(file, '2HIf')
+        data = read_struct(file, codecs['texture_info'])
         self.Attributes = data[0] # flags for this texture
         self.AnimType = data[1] # animation logic
         self.FrameCount = data[2] # Number of frames (1 if not animated)
         self.FrameRate = data[3] # Frame rate, frames per second in floating point
 
     def pack(self):
-        self.binary = struct.pack('2HIf',
+        self.binary = codecs['texture_info'].pack(
             self.Attributes,
             self.AnimType,
             self.FrameCount,
             self.FrameRate
         )
-        self.size = struct.calcsize('2HIf')
+        self.size = codecs['texture_info'].size
 
 class node_hierarchy_header(node):
+    __slots__ = ('Version', 'Name', 'NumPivots', 'Center')
+
     def __init__(self):
         super(node_hierarchy_header, self).__init__()
         self.Version = ver(4,1)
@@ -784,97 +1176,71 @@ class node_hierarchy_header(node):
         self.NumPivots = 0
         self.Center = (0, 0, 0)
     def read(self, file, size):
-        data = read_struct(file, 'L16sL3f')
+        data = read_struct(file, codecs['hierarchy_header'])
         self.Version = data[0]
         self.Name = b2s(data[1])
         self.NumPivots = data[2]
         self.Center = (data[3], data[4], data[5])
     def pack(self):
-        self.binary = struct.pack('L16sL3f',
+        self.binary = codecs['hierarchy_header'].pack(
             self.Version,
             s2b(self.Name, 16),
             self.NumPivots,
             self.Center[0],self.Center[1],self.Center[2],
         )
-        self.size += struct.calcsize('L16sL3f')
+        self.size = codecs['hierarchy_header'].size
 
 class node_pivots(node):
+    __slots__ = ('pivots',)
+
     def __init__(self):
         super(node_pivots, self).__init__()
         self.pivots = []
     def read(self, file, size):
-        while size > 0:
-            data = read_struct(file, '16sL3f3f4f')
-            self.pivots.append({
-                'Name': b2s(data[0]),
-                'ParentIdx': data[1],
-                'Translation': (data[2],data[3],data[4]),
-                'EulerAngles': (data[5],data[6],data[7]),
-                'Rotation': (data[8],data[9],data[10],data[11])
-            })
-            size -= struct.calcsize('16sL3f3f4f')
+        for data in read_elements(file, size, codecs['pivots']):
+            self.pivots.append(record_pivot(
+                b2s(data[0]),
+                data[1],
+                (data[2],data[3],data[4]),
+                (data[5],data[6],data[7]),
+                (data[8],data[9],data[10],data[11])
+            ))
     def pack(self):
-        self.binary = b''
-        for p in self.pivots:
-            self.binary += struct.pack('16sL3f3f4f',
-                s2b(p['Name'], 16),
-                p['ParentIdx'],
-                p['Translation'][0],p['Translation'][1],p['Translation'][2],
-                p['EulerAngles'][0],p['EulerAngles'][1],p['EulerAngles'][2],
-                p['Rotation'][0],p['Rotation'][1],p['Rotation'][2],p['Rotation'][3]
-            )
-            self.size += struct.calcsize('16sL3f3f4f')
+        self.binary = b''.join(codecs['pivots'].pack(
+            s2b(p['Name'], 16),
+            p['ParentIdx'],
+            p['Translation'][0],p['Translation'][1],p['Translation'][2],
+            p['EulerAngles'][0],p['EulerAngles'][1],p['EulerAngles'][2],
+            p['Rotation'][0],p['Rotation'][1],p['Rotation'][2],p['Rotation'][3]
+        ) for p in self.pivots)
+        self.size = len(self.binary)
 
 class node_compressed_animation(node):
+    __slots__ = ()
+    container = True
+
     def read(self, file, size):
-        # Manually read the animation because the channel's format is dependent on the header's flavor
-        # The header node type is just generic compressed_animation_channel
-        read_header(file) # read node header first (unused)
-        header = node_compressed_animation_header()
-        header.read(file, size)
-        size -= struct.calcsize('I16s16sI2H')
+        # The channels' format depends on the header's flavor, so the header
+        # (always the first chunk) is decoded before the rest.
+        data = read_struct(file, codecs['header'])
+        hsize = data[1] & 0x7FFFFFFF
+        start = file.tell()
 
-        self.children.append(header)
+        header = node_compressed_animation_header()
+        header.read(file, hsize)
+        if getattr(file, 'track', False):
+            header._source = (start - 8, hsize)
+        file.seek(start + hsize)
+        size -= 8 + hsize
 
-        # Special parse_nodes
-        while size > 0:
-            ci = read_header(file)
-            if ci == None:
-                continue
+        types = dict(node_types)
+        types[w3d_save_keys['COMPRESSED_ANIMATION_CHANNEL']] = compressed_channel_types.get(header.Flavor)
 
-            if ci[0] == 'ERROR':
-                print('Trying to parse unknown node (ERROR) - cannot continue')
-                break
-            
-            # Normal parsing for any non-special nodes
-            if ci[0].lower() != 'compressed_animation_channel':
-                # instantiate and load node
-                try:
-                    the_node = globals()['node_' + ci[0].lower()]()
-                    the_node.read(file, ci[1])
-                    self.children.append(the_node)
-                except KeyError:
-                    file.read(ci[1]) # Skip the node's data
-                    print('ignored: node_' + ci[0].lower())
-            else:
-                # Our special nodes
-                channel = None
-                if header.Flavor == 0:
-                    channel = node_timecoded_animation_channel()
-                elif header.Flavor == 1:
-                    channel = node_adaptivedelta_animation_channel()
-
-                if channel != None:
-                    channel.read(file, ci[1])
-                    self.children.append(channel)
-                else:
-                    file.read(ci[1]) # Skip node data
-
-            
-            # limit size for nested chunks
-            size -= 8 + ci[1] # header size + chunk size
+        self.children = [header] + parse_nodes(file, size, types)
 
 class node_compressed_animation_header(node):
+    __slots__ = ('Version', 'Name', 'HierarchyName', 'NumFrames', 'FrameRate', 'Flavor')
+
     def __init__(self):
         super(node_compressed_animation_header, self).__init__()
 
@@ -886,7 +1252,7 @@ class node_compressed_animation_header(node):
         self.Flavor = 0 # Compression type (0-timecoded, 1-adaptive delta, 2-valid)
 
     def read(self, file, size):
-        data = read_struct(file, 'I16s16sI2H')
+        data = read_struct(file, codecs['compressed_animation_header'])
         
         self.Version = data[0]
         self.Name = b2s(data[1])
@@ -898,7 +1264,7 @@ class node_compressed_animation_header(node):
         print('anim ' + self.Name + '.' + self.HierarchyName + ' framecount ' + str(self.NumFrames) + ' framerate ' + str(self.FrameRate) + ' flavor ' + str(self.Flavor))
 
     def pack(self):
-        self.binary = struct.pack('I16s16sI2H',
+        self.binary = codecs['compressed_animation_header'].pack(
             self.Version,
             s2b(self.Name),
             s2b(self.HierarchyName),
@@ -906,9 +1272,12 @@ class node_compressed_animation_header(node):
             self.FrameRate,
             self.Flavor
         )
-        self.size = struct.calcsize('I16s16sI2H')
+        self.size = codecs['compressed_animation_header'].size
 
 class node_timecoded_animation_channel(node):
+    __slots__ = ('NumTimeCodes', 'Pivot', 'VectorLen', 'Flags', 'Data')
+    chunk_id = w3d_save_keys['COMPRESSED_ANIMATION_CHANNEL']
+
     def __init__(self):
         super(node_timecoded_animation_channel, self).__init__()
 
@@ -919,26 +1288,267 @@ class node_timecoded_animation_channel(node):
         self.Data = ''
 
     def read(self, file, size):
-        data = read_struct(file, 'IH2B')
+        data = read_struct(file, codecs['timecoded_animation_channel'])
         
         self.NumTimeCodes = data[0] # number of time coded entries
         self.Pivot = data[1] # pivot affected by this channel
         self.VectorLen = data[2] # length of each vector in this channel
         self.Flags = data[3] # channel type.
 
-        # FIXME: Temporary until I figure out how to calculate size
-        self.Data = file.read(size - struct.calcsize('IH2B')) # will be (NumTimeCodes * ((VectorLen * sizeof(uint32)) + sizeof(uint32)))
+        # NumTimeCodes keys of a u32 time code and VectorLen f32 values,
+        # see keys(). Whatever follows them is kept too, for pack().
+        self.Data = file.read(size - codecs['timecoded_animation_channel'].size)
+        if len(self.Data) < self.NumTimeCodes * (self.VectorLen + 1) * 4:
+            raise ParseError('Timecoded animation channel is shorter than its keys')
 
         print('timecoded anim ' + str(self.NumTimeCodes) + ' pivot ' + str(self.Pivot) + ' vectorlen ' + str(self.VectorLen) + ' flags ' + str(self.Flags))
 
+    def keys(self):
+        """Returns the frames of the keys, whether each is a binary movement
+        key (the high bit of the time code) and their values, NumTimeCodes
+        by VectorLen. Arrays with numpy, lists without.
+        """
+        n = self.NumTimeCodes
+        if np is not None:
+            packets = np.frombuffer(self.Data, dtype=np.dtype([
+                ('TimeCode', '<u4'), ('Values', '<f4', (self.VectorLen,)),
+            ]), count=n)
+            codes = packets['TimeCode']
+            return codes & 0x7FFFFFFF, (codes & 0x80000000) != 0, packets['Values'].reshape(n, self.VectorLen)
+
+        codec = struct.Struct('<I%df' % self.VectorLen)
+        packets = list(codec.iter_unpack(self.Data[:n * codec.size]))
+        return (
+            [p[0] & 0x7FFFFFFF for p in packets],
+            [(p[0] & 0x80000000) != 0 for p in packets],
+            [list(p[1:]) for p in packets],
+        )
+
+    def frames(self, num_frames: int):
+        """Values of the channel at frames 0 to num_frames - 1, see
+        interpolate_keys.
+        """
+        times, binary, values = self.keys()
+        return interpolate_keys(times, binary, values, num_frames, self.VectorLen, self.Flags == 6)
+
     def pack(self):
-        pass
+        self.binary = codecs['timecoded_animation_channel'].pack(
+            self.NumTimeCodes,
+            self.Pivot,
+            self.VectorLen,
+            self.Flags
+        ) + bytes(self.Data)
+        self.size = len(self.binary)
+
+def interpolate_keys(times, binary, values, num_frames: int, vector_len: int, quaternion=False):
+    """Samples a keyed channel at every frame from 0 to num_frames - 1.
+
+    Between two keys values are interpolated, linearly or, for quaternions,
+    spherically, unless the second one is a binary movement key: then the
+    first one's value holds until it. Frames before the first key and after
+    the last one take their value. Returns a num_frames by vector_len float32
+    array with numpy, a list of lists without.
+    """
+    n = len(times)
+
+    if np is not None:
+        if n == 0:
+            return np.zeros((num_frames, vector_len), dtype=np.float32)
+
+        frames = np.arange(num_frames)
+        times = np.asarray(times, dtype=np.float64)
+
+        # Keys on either side of each frame
+        i = np.clip(np.searchsorted(times, frames, side='right') - 1, 0, n - 1)
+        j = np.minimum(i + 1, n - 1)
+
+        span = times[j] - times[i]
+        t = np.zeros(num_frames)
+        np.divide(frames - times[i], span, out=t, where=span > 0)
+        t = np.clip(t, 0.0, 1.0)
+        t[np.asarray(binary)[j]] = 0.0
+
+        values = np.asarray(values, dtype=np.float64)
+        a = values[i]
+        b = values[j]
+        if quaternion:
+            return slerp(a, b, t).astype(np.float32)
+        return (a + (b - a) * t[:, None]).astype(np.float32)
+
+    out = []
+    for f in range(num_frames):
+        if n == 0:
+            out.append([0.0] * vector_len)
+            continue
+
+        i = min(max(bisect.bisect_right(times, f) - 1, 0), n - 1)
+        j = min(i + 1, n - 1)
+        span = times[j] - times[i]
+        t = min(max((f - times[i]) / span, 0.0), 1.0) if span > 0 else 0.0
+        if binary[j]:
+            t = 0.0
+
+        if quaternion:
+            out.append(slerp([values[i]], [values[j]], [t])[0])
+        else:
+            out.append([a + (b - a) * t for a, b in zip(values[i], values[j])])
+
+    return out
+
+def slerp(a, b, t):
+    """Spherical interpolation between the quaternions of a and b, row by
+    row, by the fractions in t. Arrays with numpy, lists without.
+    """
+    if np is not None:
+        dot = np.sum(a * b, axis=1)
+
+        # Take the short way round
+        b = np.where(dot[:, None] < 0, -b, b)
+        dot = np.abs(dot)
+
+        theta = np.arccos(np.clip(dot, -1.0, 1.0))
+        sin = np.sin(theta)
+        near = sin < 1e-6
+        sin[near] = 1.0
+        wa = np.where(near, 1.0 - t, np.sin((1.0 - t) * theta) / sin)
+        wb = np.where(near, t, np.sin(t * theta) / sin)
+        return a * wa[:, None] + b * wb[:, None]
+
+    out = []
+    for qa, qb, f in zip(a, b, t):
+        dot = sum(x * y for x, y in zip(qa, qb))
+        if dot < 0:
+            qb = [-x for x in qb]
+            dot = -dot
+
+        theta = math.acos(min(dot, 1.0))
+        sin = math.sin(theta)
+        if sin < 1e-6:
+            wa, wb = 1.0 - f, f
+        else:
+            wa, wb = math.sin((1.0 - f) * theta) / sin, math.sin(f * theta) / sin
+        out.append([x * wa + y * wb for x, y in zip(qa, qb)])
+
+    return out
 
 class node_adaptivedelta_animation_channel(node):
+    __slots__ = ('NumFrames', 'Pivot', 'VectorLen', 'Flags', 'Scale', 'Data')
+    chunk_id = w3d_save_keys['COMPRESSED_ANIMATION_CHANNEL']
+
     def __init__(self):
         super(node_adaptivedelta_animation_channel, self).__init__()
 
+        self.NumFrames = 0
+        self.Pivot = 0
+        self.VectorLen = 0
+        self.Flags = 0
+        self.Scale = 0.0
+        self.Data = ''
+
+    def read(self, file, size):
+        data = read_struct(file, codecs['adaptivedelta_animation_channel'])
+
+        self.NumFrames = data[0] # number of frames, the first one included
+        self.Pivot = data[1] # pivot affected by this channel
+        self.VectorLen = data[2] # length of each vector in this channel
+        self.Flags = data[3] # channel type.
+        self.Scale = data[4] # scale of the deltas
+
+        # The VectorLen f32 values of the first frame, then the deltas of
+        # the other frames in blocks, see frames(). Kept as is for pack().
+        self.Data = file.read(size - codecs['adaptivedelta_animation_channel'].size)
+        if len(self.Data) < self.VectorLen * 4 + self.num_blocks() * self.VectorLen * codecs['adaptivedelta_block'].size:
+            raise ParseError('Adaptive delta animation channel is shorter than its deltas')
+
+        print('adaptive delta anim ' + str(self.NumFrames) + ' pivot ' + str(self.Pivot) + ' vectorlen ' + str(self.VectorLen) + ' flags ' + str(self.Flags))
+
+    def num_blocks(self) -> int:
+        """Number of blocks of deltas, each covers 16 frames after the first
+        one.
+        """
+        return ceil(max(self.NumFrames - 1, 0) / 16)
+
+    def frames(self, num_frames: int):
+        """Values of the channel at frames 0 to num_frames - 1 (the last
+        one holds if the channel is shorter), num_frames by VectorLen.
+        Array with numpy, list of lists without.
+
+        Blocks come per 16 frames, then per vector element: an index in
+        delta_filter and 16 signed 4-bit deltas, low nibble first. A value is
+        the one of the previous frame plus delta * delta_filter[index] * Scale.
+        """
+        vl = self.VectorLen
+        n = self.NumFrames
+        nblocks = self.num_blocks()
+        block = codecs['adaptivedelta_block']
+
+        if np is not None:
+            initial = np.frombuffer(self.Data, dtype='<f4', count=vl)
+            blocks = np.frombuffer(
+                self.Data, dtype=np.uint8, count=nblocks * vl * block.size, offset=vl * 4
+            ).reshape(nblocks, vl, block.size)
+
+            packed = blocks[:, :, 1:]
+            nibbles = np.empty((nblocks, vl, 16), dtype=np.int8)
+            nibbles[:, :, 0::2] = packed & 0x0F
+            nibbles[:, :, 1::2] = packed >> 4
+            deltas = (nibbles ^ 8) - 8 # sign extended
+
+            # Every block of every element at once, then one running sum
+            scales = np.array(delta_filter)[blocks[:, :, 0]] * self.Scale
+            steps = (deltas * scales[:, :, None]).transpose(0, 2, 1).reshape(nblocks * 16, vl)
+
+            out = np.empty((max(n, 1), vl), dtype=np.float64)
+            out[0] = initial
+            np.cumsum(steps[:n - 1], axis=0, out=out[1:])
+            out[1:] += initial
+
+            out = out[:num_frames]
+            if len(out) < num_frames:
+                out = np.concatenate([out, np.repeat(out[-1:], num_frames - len(out), axis=0)])
+            return out.astype(np.float32)
+
+        value = list(struct.unpack_from('<%df' % vl, self.Data))
+        out = [value]
+        for b in range(nblocks):
+            steps = []
+            for v in range(vl):
+                index, packed = block.unpack_from(self.Data, vl * 4 + (b * vl + v) * block.size)
+                scale = delta_filter[index] * self.Scale
+                deltas = []
+                for byte in packed:
+                    deltas += [(byte & 0x0F ^ 8) - 8, (byte >> 4 ^ 8) - 8]
+                steps.append([d * scale for d in deltas])
+
+            for f in range(16):
+                if len(out) >= n:
+                    break
+                value = [x + steps[v][f] for v, x in enumerate(value)]
+                out.append(value)
+
+        out = out[:num_frames]
+        return out + [list(out[-1]) for i in range(num_frames - len(out))]
+
+    def pack(self):
+        self.binary = codecs['adaptivedelta_animation_channel'].pack(
+            self.NumFrames,
+            self.Pivot,
+            self.VectorLen,
+            self.Flags,
+            self.Scale
+        ) + bytes(self.Data)
+        self.size = len(self.binary)
+
+# Scales of the blocks of adaptive delta channels: powers of ten from 1e-8
+# to 1e7, then 240 steps of 1 - sin from 1 down towards 0
+delta_filter = [10.0 ** (i - 8) for i in range(16)] + [
+    1.0 - math.sin(math.radians(90.0 * i / 240.0)) for i in range(240)
+]
+
 class node_animation(node):
+    __slots__ = ()
+    container = True
+
     def read(self, file, size):
         self.children = parse_nodes(file, size)
 
@@ -948,6 +1558,8 @@ class node_animation_header(node):
     NumFrames: int
     FrameRate: int
 
+    __slots__ = ('Version', 'Name', 'HierarchyName', 'NumFrames', 'FrameRate')
+
     def __init__(self):
         super(node_animation_header, self).__init__()
 
@@ -958,7 +1570,7 @@ class node_animation_header(node):
         self.FrameRate = 0
 
     def read(self, file, size):
-        data = read_struct(file, 'I16s16s2I')
+        data = read_struct(file, codecs['animation_header'])
         self.Version = data[0]
         self.Name = b2s(data[1])
         self.HierarchyName = b2s(data[2])
@@ -968,16 +1580,18 @@ class node_animation_header(node):
         print('anim ' + self.Name + '.' + self.HierarchyName + ' framecount ' + str(self.NumFrames) + ' framerate ' + str(self.FrameRate))
 
     def pack(self):
-        self.binary = struct.pack('I16s16s2I',
+        self.binary = codecs['animation_header'].pack(
             self.Version,
             s2b(self.Name),
             s2b(self.HierarchyName),
             self.NumFrames,
             self.FrameRate
         )
-        self.size = struct.calcsize('I16s16s2I')
+        self.size = codecs['animation_header'].size
 
 class node_animation_channel(node):
+    __slots__ = ('FirstFrame', 'LastFrame', 'VectorLen', 'Flags', 'Pivot', 'Data')
+
     def __init__(self):
         super(node_animation_channel, self).__init__()
 
@@ -998,7 +1612,7 @@ class node_animation_channel(node):
         # u16 Pivot
         # u16 pad
         # f32 Data[...]
-        data = read_struct(file, '6H')
+        data = read_struct(file, codecs['animation_channel'])
         self.FirstFrame = data[0]
         self.LastFrame = data[1]
         self.VectorLen = data[2] # length of each vector in this channel
@@ -1013,8 +1627,22 @@ class node_animation_channel(node):
         end = file.tell()
         file.read(size - (end - start)) # Skip unused bytes (??)
 
+    def frames(self):
+        """Values of the channel from FirstFrame to LastFrame, a view of Data
+        shaped (frames, VectorLen) with numpy, a list of lists without.
+        """
+        count = self.LastFrame - self.FirstFrame + 1
+        if len(self.Data) != count * self.VectorLen * 4:
+            raise ParseError('Animation channel has bad data length')
+
+        if np is not None:
+            return np.frombuffer(self.Data, dtype='<f4').reshape(count, self.VectorLen)
+
+        codec = struct.Struct('<%df' % self.VectorLen)
+        return [list(v) for v in codec.iter_unpack(self.Data)]
+
     def pack(self):
-        self.binary = struct.pack('6H',
+        self.binary = codecs['animation_channel'].pack(
             self.FirstFrame,
             self.LastFrame,
             self.VectorLen,
@@ -1022,10 +1650,12 @@ class node_animation_channel(node):
             self.Pivot,
             0,
         )
-        self.binary += s2b(self.Data)
+        self.binary += bytes(self.Data)
         self.size = len(self.binary)
 
 class node_bit_channel(node):
+    __slots__ = ('FirstFrame', 'LastFrame', 'Flags', 'Pivot', 'DefaultVal', 'Data')
+
     def __init__(self):
         super(node_bit_channel, self).__init__()
 
@@ -1037,7 +1667,7 @@ class node_bit_channel(node):
         self.Data = ''
 
     def read(self, file, size):
-        data = read_struct(file, '4HB')
+        data = read_struct(file, codecs['bit_channel'])
 
         self.FirstFrame = data[0] # all frames outside "First" and "Last" are assumed = DefaultVal
         self.LastFrame = data[1]
@@ -1049,71 +1679,109 @@ class node_bit_channel(node):
 
         print('bit channel ' + str(self.FirstFrame) + ' to ' + str(self.LastFrame) + ' flags ' + str(self.Flags) + ' pivot ' + str(self.Pivot) + ' default ' + str(self.DefaultVal))
 
+    def frames(self, num_frames: int):
+        """The bit of every frame from 0 to num_frames - 1, DefaultVal outside
+        FirstFrame to LastFrame. Bits are stored from the lowest of each
+        byte. A bool array with numpy, a list of bools without.
+        """
+        count = self.LastFrame - self.FirstFrame + 1
+        if len(self.Data) < ceil(count / 8):
+            raise ParseError('Bit channel has bad data length')
+
+        first = min(self.FirstFrame, num_frames)
+        last = min(self.LastFrame + 1, num_frames)
+
+        if np is not None:
+            # unpackbits starts from the highest bit, so each byte is reversed
+            bits = np.unpackbits(np.frombuffer(self.Data, dtype=np.uint8)).reshape(-1, 8)[:, ::-1].ravel()
+            out = np.full(num_frames, bool(self.DefaultVal))
+            out[first:last] = bits[:max(last - first, 0)]
+            return out
+
+        out = [bool(self.DefaultVal)] * num_frames
+        for f in range(first, last):
+            i = f - self.FirstFrame
+            out[f] = bool(self.Data[i >> 3] >> (i & 7) & 1)
+        return out
+
     def pack(self):
-        # TODO
-        raise NotImplementedError()
+        self.binary = codecs['bit_channel'].pack(
+            self.FirstFrame,
+            self.LastFrame,
+            self.Flags,
+            self.Pivot,
+            self.DefaultVal
+        ) + bytes(self.Data)
+        self.size = len(self.binary)
 
 class node_aggregate(node):
+    __slots__ = ()
+    container = True
+
     def read(self, file, size):
         self.children = parse_nodes(file, size)
 
 class node_aggregate_header(node):
+    __slots__ = ('Version', 'Name')
+
     def read(self, file, size):
-        data = read_struct(file, 'L16s')
+        data = read_struct(file, codecs['aggregate_header'])
         self.Version = data[0]
         self.Name = b2s(data[1])
     def pack(self):
-        self.binary = struct.pack('L16s',
+        self.binary = codecs['aggregate_header'].pack(
             self.Version,
             s2b(self.Name)
         )
-        self.size += struct.calcsize('L16s')
+        self.size = codecs['aggregate_header'].size
 
 class node_aggregate_info(node):
+    __slots__ = ('BaseModelName', 'SubobjectCount', 'Subobjects')
+
     def read(self, file, size):
-        data = read_struct(file, '32sL')
+        data = read_struct(file, codecs['aggregate_info'])
         self.BaseModelName = b2s(data[0])
         self.SubobjectCount = data[1]
-        size -= struct.calcsize('32sL')
+        size -= codecs['aggregate_info'].size
         
         self.Subobjects = []
-        while size > 0:
-            data = read_struct(file, '32s32s')
-            self.Subobjects.append({
-                'SubobjectName': b2s(data[0]),
-                'BoneName': b2s(data[1])
-            })
-            size -= struct.calcsize('32s32s')
+        for data in read_elements(file, size, codecs['aggregate_subobject']):
+            self.Subobjects.append(record_subobject(b2s(data[0]), b2s(data[1])))
     def pack(self):
-        self.binary = struct.pack('32sL',
+        self.binary = codecs['aggregate_info'].pack(
             s2b(self.BaseModelName),
             self.SubobjectCount
         )
-        self.size = struct.calcsize('32sL')
-        for s in self.Subobjects:
-            self.binary += struct.pack('32s32s',
-                s2b(s['SubobjectName'], 32), s2b(s['BoneName'], 32)
-            )
-            self.size += struct.calcsize('32s32s')
+        self.binary += b''.join(codecs['aggregate_subobject'].pack(
+            s2b(s['SubobjectName'], 32), s2b(s['BoneName'], 32)
+        ) for s in self.Subobjects)
+        self.size = len(self.binary)
 
 class node_aggregate_class_info(node):
+    __slots__ = ('OriginalClassID', 'Flags')
+
     def read(self, file, size):
-        data = read_struct(file, 'LL3L')
+        data = read_struct(file, codecs['aggregate_class_info'])
         self.OriginalClassID = data[0]
         self.Flags = data[1]
     def pack(self):
-        self.binary = struct.pack('LL3L',
+        self.binary = codecs['aggregate_class_info'].pack(
             self.OriginalClassID,
             self.Flags,
             0, 0, 0
         )
-        self.size += struct.calcsize('LL3L')
+        self.size = codecs['aggregate_class_info'].size
 
 class node_hlod(node):
+    __slots__ = ()
+    container = True
+
     def read(self, file, size):
         self.children = parse_nodes(file, size)
 
 class node_hlod_header(node):
+    __slots__ = ('Version', 'LodCount', 'Name', 'HierarchyName')
+
     def __init__(self):
         super(node_hlod_header, self).__init__()
         self.Version = ver(1,0)
@@ -1121,67 +1789,82 @@ class node_hlod_header(node):
         self.Name = 'UNTITLED'
         self.HierarchyName = 'UNTITLED'
     def read(self, file, size):
-        data = read_struct(file, 'LL16s16s')
+        data = read_struct(file, codecs['hlod_header'])
         self.Version = data[0]
         self.LodCount = data[1]
         self.Name = b2s(data[2])
         self.HierarchyName = b2s(data[3])
     def pack(self):
-        self.binary = struct.pack('LL16s16s',
+        self.binary = codecs['hlod_header'].pack(
             self.Version,
             self.LodCount,
             s2b(self.Name, 16),
             s2b(self.HierarchyName, 16)
         )
-        self.size += struct.calcsize('LL16s16s')
+        self.size = codecs['hlod_header'].size
 
 class node_hlod_lod_array(node):
+    __slots__ = ()
+    container = True
+
     def read(self, file, size):
         self.children = parse_nodes(file, size)
 
 class node_hlod_aggregate_array(node):
+    __slots__ = ()
+    container = True
+
     def read(self, file, size):
         self.children = parse_nodes(file, size)
 
 class node_hlod_proxy_array(node):
+    __slots__ = ()
+    container = True
+
     def read(self, file, size):
         self.children = parse_nodes(file, size)
 
 class node_hlod_sub_object_array_header(node):
+    __slots__ = ('ModelCount', 'MaxScreenSize')
+
     def __init__(self):
         super(node_hlod_sub_object_array_header, self).__init__()
         self.ModelCount = 0
         self.MaxScreenSize = 0.0
     def read(self, file, size):
-        data = read_struct(file, 'Lf')
+        data = read_struct(file, codecs['hlod_sub_object_array_header'])
         self.ModelCount = data[0]
         self.MaxScreenSize = data[1]
     def pack(self):
-        self.binary = struct.pack('Lf',
+        self.binary = codecs['hlod_sub_object_array_header'].pack(
             self.ModelCount,
             self.MaxScreenSize
         )
-        self.size += struct.calcsize('Lf')
+        self.size = codecs['hlod_sub_object_array_header'].size
 
 class node_hlod_sub_object(node):
+    __slots__ = ('BoneIndex', 'Name')
+
     def __init__(self):
         super(node_hlod_sub_object, self).__init__()
         self.BoneIndex = 0
         self.Name = 'UNTITLED'
     def read(self, file, size):
-        data = read_struct(file, 'L32s')
+        data = read_struct(file, codecs['hlod_sub_object'])
         self.BoneIndex = data[0]
         self.Name = b2s(data[1])
     def pack(self):
-        self.binary = struct.pack('L32s',
+        self.binary = codecs['hlod_sub_object'].pack(
             self.BoneIndex,
             s2b(self.Name, 32)
         )
-        self.size += struct.calcsize('L32s')
+        self.size = codecs['hlod_sub_object'].size
 
 class node_box(node):
+    __slots__ = ('Version', 'Attributes', 'Name', 'Color', 'Center', 'Extent', 'blender_object')
+
     def read(self, file, size):
-        data = read_struct(file, 'LL32s4B3f3f')
+        data = read_struct(file, codecs['box'])
         self.Version = data[0]
         self.Attributes = data[1]
         self.Name = b2s(data[2])
@@ -1189,7 +1872,7 @@ class node_box(node):
         self.Center = (data[7], data[8], data[9])
         self.Extent = (data[10], data[11], data[12])
     def pack(self):
-        self.binary = struct.pack('LL32s4B3f3f',
+        self.binary = codecs['box'].pack(
             self.Version,
             self.Attributes,
             s2b(self.Name, 32),
@@ -1197,11 +1880,13 @@ class node_box(node):
             self.Center[0], self.Center[1], self.Center[2],
             self.Extent[0], self.Extent[1], self.Extent[2],
         )
-        self.size += struct.calcsize('LL32s4B3f3f')
+        self.size = codecs['box'].size
 
 class node_sphere(node):
+    __slots__ = ('Version', 'Attributes', 'Name', 'Color', 'Center', 'Extent', 'blender_object')
+
     def read(self, file, size):
-        data = read_struct(file, 'LL32s4B3f3f')
+        data = read_struct(file, codecs['sphere'])
         self.Version = data[0]
         self.Attributes = data[1]
         self.Name = b2s(data[2])
@@ -1209,7 +1894,7 @@ class node_sphere(node):
         self.Center = (data[7], data[8], data[9])
         self.Extent = (data[10], data[11], data[12])
     def pack(self):
-        self.binary = struct.pack('LL32s4B3f3f',
+        self.binary = codecs['sphere'].pack(
             self.Version,
             self.Attributes,
             s2b(self.Name),
@@ -1217,11 +1902,13 @@ class node_sphere(node):
             self.Center[0], self.Center[1], self.Center[2],
             self.Extent[0], self.Extent[1], self.Extent[2],
         )
-        self.size += struct.calcsize('LL32s4B3f3f')
+        self.size = codecs['sphere'].size
 
 class node_ring(node):
+    __slots__ = ('Version', 'Attributes', 'Name', 'Color', 'Center', 'Extent', 'blender_object')
+
     def read(self, file, size):
-        data = read_struct(file, 'LL32s4B3f3f')
+        data = read_struct(file, codecs['ring'])
         self.Version = data[0]
         self.Attributes = data[1]
         self.Name = b2s(data[2])
@@ -1229,7 +1916,7 @@ class node_ring(node):
         self.Center = (data[7], data[8], data[9])
         self.Extent = (data[10], data[11], data[12])
     def pack(self):
-        self.binary = struct.pack('LL32s4B3f3f',
+        self.binary = codecs['ring'].pack(
             self.Version,
             self.Attributes,
             s2b(self.Name),
@@ -1237,12 +1924,94 @@ class node_ring(node):
             self.Center[0], self.Center[1], self.Center[2],
             self.Extent[0], self.Extent[1], self.Extent[2],
         )
-        self.size += struct.calcsize('LL32s4B3f3f')
+        self.size = codecs['ring'].size
 
 class node_(node):
+    __slots__ = ()
+    container = True
+
     def read(self, file, size):
         self.children = parse_nodes(file, size)
-        
+
+class node_root(node):
+    """The top of a loaded file. Not a chunk, it only holds the top level
+    chunks and what the loader has to say about the file.
+    """
+    __slots__ = ('unknown_chunks', 'source', 'buffer')
+
+    def close(self):
+        """Closes the file a tree opened with edit() reads from.
+
+        What is still lazy is decoded, and the arrays and blobs that point
+        into the file are copied, so the tree stays usable. save() encodes
+        all of it from then on. Does nothing for other trees.
+        """
+        source = getattr(self, 'source', None)
+        if source is None:
+            return
+
+        self.resolve()
+        for n in self.walk():
+            if n is not self:
+                detach_fields(n)
+
+        # Raises BufferError if something else still points into the map
+        mapped = self.buffer.obj
+        self.buffer.release()
+        if isinstance(mapped, mmap.mmap):
+            mapped.close()
+        source.close()
+
+        self.source = None
+        self.buffer = None
+
+def detach_fields(n: node):
+    """Copies the arrays and blobs of n that point into the buffer it was
+    read from, and forgets where it was in the file. See node_root.close.
+    """
+    n._source = None
+    for key in n.fields():
+        value = getattr(n, key, None)
+        if isinstance(value, memoryview):
+            setattr(n, key, value.tobytes())
+        elif np is not None and isinstance(value, np.ndarray) and value.base is not None:
+            setattr(n, key, value.copy())
+
+class node_raw(node):
+    """A chunk without a decoder, kept as raw bytes so it can be written back.
+
+    chunk_type is set per instance to the chunk's real name, so it can still
+    be found with find/get, and so are chunk_id and container. That is why
+    this class keeps a __dict__ (no __slots__): the instance attributes have
+    to shadow the class ones.
+    """
+    def __init__(self):
+        super(node_raw, self).__init__()
+        self.chunk_id = 0
+        self.binary = b''
+
+    def read(self, file, size):
+        self.binary = file.read(size)
+
+    def pack(self):
+        self.size = len(self.binary)
+
+# chunk id -> node class, for every chunk that can be decoded
+node_types = {
+    id: globals()['node_' + name.lower()]
+    for id, name in w3d_keys.items()
+    if 'node_' + name.lower() in globals()
+}
+
+# compressed animation flavor -> channel class
+compressed_channel_types = {
+    0: node_timecoded_animation_channel,
+    1: node_adaptivedelta_animation_channel,
+}
+
+# What parse_nodes does with chunks that have no decoder
+unknown_policies = ('skip', 'raw', 'count')
+
 # loading algorithm
 class ParseError(Exception):
     """Exception raised when an error is encountered while parsing a w3d archive.
@@ -1256,52 +2025,217 @@ class ParseError(Exception):
     def __str__(self):
         return self.message
 
-def read_struct(file: BinaryIO, fmt) -> Optional[Tuple]:
-    binary = file.read(struct.calcsize(fmt))
+class ChunkReader():
+    """File-like cursor over a w3d file that is already in memory.
+
+    read() returns memoryview slices of the buffer rather than copies, so
+    when the buffer is a memory map the payloads are decoded straight out of
+    the mapped pages.
+
+    It also carries the parse options down to nested parse_nodes calls:
+    with lazy set, parse_nodes only records where each chunk is and leaves
+    the payload to be decoded when the node is first used. unknown is one of
+    unknown_policies; 'count' tallies skipped chunks by name in skipped.
+    exclude is a compiled chunk_filter, chunks it matches are skipped. track
+    has every node remember where its chunk is, see edit().
+    """
+    def __init__(self, buffer, offset=0, lazy=False, unknown='skip', exclude=None, track=False):
+        if unknown not in unknown_policies:
+            raise ValueError('unknown chunk policy must be one of ' + ', '.join(unknown_policies))
+
+        self.view = memoryview(buffer)
+        self.offset = offset
+        self.lazy = lazy
+        self.unknown = unknown
+        self.exclude: Optional[typing.Pattern] = exclude
+        self.track = track
+        self.skipped: Dict[str, int] = {}
+
+    def at(self, offset) -> ChunkReader:
+        """Returns a new cursor over the same buffer, sharing the options.
+        """
+        reader = ChunkReader(self.view, offset, self.lazy, self.unknown, self.exclude, self.track)
+        reader.skipped = self.skipped
+        return reader
+
+    def read(self, size=-1) -> memoryview:
+        start = self.offset
+        end = len(self.view)
+        if size >= 0:
+            end = min(start + size, end)
+
+        self.offset = end
+        return self.view[start:end]
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.offset
+        elif whence == 2:
+            offset += len(self.view)
+        self.offset = offset
+        return offset
+
+    def tell(self):
+        return self.offset
+
+    def unpack(self, codec: struct.Struct) -> Optional[Tuple]:
+        if self.offset >= len(self.view):
+            return None
+
+        data = codec.unpack_from(self.view, self.offset)
+        self.offset += codec.size
+        return data
+
+def read_struct(file: BinaryIO, codec: struct.Struct) -> Optional[Tuple]:
+    if isinstance(file, ChunkReader):
+        return file.unpack(codec)
+
+    binary = file.read(codec.size)
     
     if binary == b'':
         return None
     
-    data = struct.unpack(fmt, binary)
-    return data
+    return codec.unpack(binary)
     
-def read_header(file: BinaryIO) -> Optional[Tuple[str, int]]:
-    data = read_struct(file, 'LL')
+# Byte size of the numpy dtypes used by array chunks
+dtype_sizes = {'<f4': 4, '<u4': 4, 'u1': 1}
+
+triangle_dtype = None if np is None else np.dtype([
+    ('Vindex', '<u4', (3,)),
+    ('Attributes', '<u4'),
+    ('Normal', '<f4', (3,)),
+    ('Dist', '<f4'),
+])
+
+def read_elements(file: BinaryIO, size: int, codec: struct.Struct):
+    """Iterates over the records of a chunk made of fixed size elements.
+    """
+    count = size // codec.size
+    return codec.iter_unpack(file.read(size)[:count * codec.size])
+
+def read_array(file: BinaryIO, size: int, codec: struct.Struct, dtype: str):
+    """Decodes a chunk of fixed size elements in one pass.
+
+    codec is the layout of one element, made of width values of dtype.
+    Returns an array of shape (count,) or (count, width) when numpy is
+    available, otherwise a list of ints or tuples.
+    """
+    width = codec.size // dtype_sizes[dtype]
+
+    if np is not None:
+        count = size // codec.size
+        data = np.frombuffer(file.read(size), dtype=dtype, count=count * width)
+        return data.reshape(count, width) if width > 1 else data
+
+    data = read_elements(file, size, codec)
+    if width == 1:
+        return [d[0] for d in data]
+    return list(data)
+
+def pack_array(values, codec: struct.Struct, dtype: str) -> bytes:
+    """Encodes the output of read_array (or a list shaped like it).
+    """
+    width = codec.size // dtype_sizes[dtype]
+
+    if np is not None:
+        if width == 1 or isinstance(values, np.ndarray):
+            return np.asarray(values, dtype=dtype).tobytes()
+
+        # Flattening a list of tuples first is a lot faster than converting it
+        data = np.fromiter(itertools.chain.from_iterable(values), dtype=dtype)
+        if data.size != len(values) * width:
+            raise ValueError('elements must have %d values each' % width)
+        return data.tobytes()
+
+    if width == 1:
+        return b''.join(codec.pack(v) for v in values)
+    return b''.join(codec.pack(*v) for v in values)
+
+def read_header(file: BinaryIO) -> Optional[Tuple[int, int]]:
+    """Reads a chunk header, returns (chunk id, payload size).
+    """
+    data = read_struct(file, codecs['header'])
     
     if data == None:
         return None
     
-    try:
-        type = w3d_keys[data[0]]
-    except KeyError:
-        type = 'ERROR'
-    
-    size = data[1] & 0x7FFFFFFF
+    return (data[0], data[1] & 0x7FFFFFFF)
     
-    return (type, size)
-    
-def parse_nodes(file: BinaryIO, size=0x7FFFFFFF) -> List[node]:
+def chunk_filter(patterns) -> Optional[typing.Pattern]:
+    """Compiles chunk type patterns, fnmatch style ('prelit_*'), into one
+    regex for load's include and exclude. None stays None (no filter).
+    """
+    if patterns is None:
+        return None
+    if isinstance(patterns, str):
+        patterns = (patterns,)
+
+    patterns = [fnmatch.translate(p.lower()) for p in patterns]
+    return re.compile('|'.join(patterns) if patterns else '(?!)')
+
+def parse_nodes(file: BinaryIO, size=0x7FFFFFFF, types=node_types, include=None) -> List[node]:
+    """Reads the chunks in the next size bytes of file.
+
+    Chunks whose type doesn't match include (a chunk_filter), or that match
+    the reader's exclude filter, are skipped without being decoded.
+    """
     nodes = []
+    lazy = getattr(file, 'lazy', False)
+    unknown = getattr(file, 'unknown', 'skip')
+    exclude = getattr(file, 'exclude', None)
+    track = getattr(file, 'track', False)
     
     while size > 0:
         offset = file.tell()
 
-        ci = read_header(file)
-        if ci == None:
+        data = read_struct(file, codecs['header'])
+        if data == None:
             break
+        ci = (data[0], data[1] & 0x7FFFFFFF)
 
-        if ci[0] == 'ERROR':
+        cls = types.get(ci[0])
+        if cls is None and ci[0] not in w3d_keys:
             raise ParseError("Unknown header node type. Is this a valid W3D file?")
 
+        filtered = False
+        if include is not None or exclude is not None:
+            name = w3d_keys[ci[0]].lower()
+            filtered = (include is not None and not include.match(name)) or \
+                (exclude is not None and exclude.match(name) is not None)
+
+        if filtered:
+            cls = None
+            file.seek(ci[1], 1) # Skip the node's data
+        elif cls is None:
+            if unknown == 'raw':
+                cls = node_raw
+            else:
+                if unknown == 'count':
+                    name = w3d_keys[ci[0]].lower()
+                    file.skipped[name] = file.skipped.get(name, 0) + 1
+                file.seek(ci[1], 1) # Skip the node's data
+
         # instantiate and load node
-        try:
-            # print('%s: %db' % (ci[0], ci[1]))
-            the_node = globals()['node_' + ci[0].lower()]()
+        if cls is None:
+            pass
+        elif lazy and cls is not node_raw:
+            # (raw chunks are read right away, they are only a slice anyway)
+            the_node = cls.__new__(cls)
+            the_node._lazy = (file, file.tell(), ci[1])
+            the_node._source = (offset, ci[1]) if track else None
+            file.seek(ci[1], 1)
+            nodes.append(the_node)
+        else:
+            the_node = cls()
             the_node.read(file, ci[1])
+            if track:
+                the_node._source = (offset, ci[1])
             nodes.append(the_node)
-        except KeyError:
-            file.read(ci[1]) # Skip the node's data
-            print('ignored: node_' + ci[0].lower())
+
+        if cls is node_raw:
+            the_node.chunk_type = w3d_keys[ci[0]].lower()
+            the_node.chunk_id = ci[0]
+            the_node.container = bool(data[1] & 0x80000000)
 
         # Make sure we've read the right number of bytes.
         assert file.tell() - offset == (8 + ci[1])
@@ -1311,19 +2245,451 @@ def parse_nodes(file: BinaryIO, size=0x7FFFFFFF) -> List[node]:
         
     return nodes
     
-def load(filepath: str) -> node:
+def load(filepath: str, lazy=False, unknown='skip', include=None, exclude=None) -> node:
+    """Loads a w3d file.
+
+    In lazy mode only the top level chunks are located up front; every
+    node decodes its payload (and locates its children) the first time one
+    of its attributes is used. resolve() forces the whole tree in.
+
+    unknown says what happens to chunks there is no decoder for: 'skip'
+    drops them, 'raw' keeps them as node_raw and 'count' drops them but
+    tallies them by name in root.unknown_chunks.
+
+    include and exclude are lists of chunk types, which may be fnmatch
+    patterns ('prelit_*'). Only the top level chunks that match include are
+    loaded, and the chunks that match exclude are skipped at any depth.
+    Either way their payload is never looked at.
+    """
+    print('load: ' + filepath)
+
+    # The map stays open for as long as decoded data still references it
+    return load_buffer(map_file(filepath), lazy, unknown, include, exclude)
+
+def map_file(filepath: str):
+    """Maps a file read only, for load_buffer and iter_chunks_buffer.
+    """
     with open(filepath, 'rb') as file:
-        print('load: ' + filepath)
+        try:
+            return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can't be mapped
+            return b''
 
-        root = node()
-        root.children = parse_nodes(cast(BinaryIO, file))
-        
-        return root
+def load_buffer(buffer, lazy=False, unknown='skip', include=None, exclude=None) -> node:
+    """Parses a w3d file from memory (bytes, mmap, memoryview...).
+
+    Decoded arrays and blobs may point into the buffer, so it must not be
+    modified while the tree is in use.
+    """
+    reader = ChunkReader(buffer, lazy=lazy, unknown=unknown, exclude=chunk_filter(exclude))
+
+    root = node_root()
+    root.children = parse_nodes(cast(BinaryIO, reader), include=chunk_filter(include))
+    if unknown == 'count':
+        root.unknown_chunks = reader.skipped
+
+    return root
     
+def iter_chunks(filepath: str, depth=None, decode=False):
+    """Walks the chunks of a w3d file without building a tree.
+
+    See iter_chunks_buffer.
+    """
+    return iter_chunks_buffer(map_file(filepath), depth, decode)
+
+def iter_chunks_buffer(buffer, depth=None, decode=False):
+    """Walks the chunks of a w3d file in memory, in file order.
+
+    Yields (path, chunk id, offset, size, payload) for every chunk, where
+    path is the tuple of chunk types from the top level chunk down to this
+    one, ('mesh', 'vertices'), offset is where the chunk header starts and
+    size is the size of the payload. Only chunks at most depth levels deep
+    are visited (depth=1 lists the top level chunks), all of them if depth
+    is None.
+
+    payload is None unless decode is set. Then it is a lazily loaded node
+    for chunks there is a decoder for, or a memoryview of the bytes for the
+    others. Nothing is kept between two chunks, so the walk runs in
+    constant memory.
+    """
+    reader = ChunkReader(buffer, lazy=True)
+
+    # End offsets of the containers the cursor is in, and their path
+    ends = []
+    path = ()
+
+    while True:
+        while ends and reader.tell() >= ends[-1]:
+            ends.pop()
+            path = path[:-1]
+
+        offset = reader.tell()
+        data = read_struct(reader, codecs['header'])
+        if data is None:
+            break
+
+        chunk_id = data[0]
+        size = data[1] & 0x7FFFFFFF
+        if chunk_id not in w3d_keys:
+            raise ParseError("Unknown header node type. Is this a valid W3D file?")
+
+        cls = node_types.get(chunk_id)
+        chunk_path = path + (w3d_keys[chunk_id].lower(),)
+
+        payload = None
+        if decode and cls is None:
+            payload = reader.view[offset + 8:offset + 8 + size]
+        elif decode:
+            payload = cls.__new__(cls)
+            payload._lazy = (reader, offset + 8, size)
+
+        yield chunk_path, chunk_id, offset, size, payload
+
+        # Chunks without a decoder have to be taken at their word
+        container = cls.container if cls is not None else bool(data[1] & 0x80000000)
+
+        if container and (depth is None or len(chunk_path) < depth):
+            ends.append(offset + 8 + size)
+            path = chunk_path
+        else:
+            reader.seek(size, 1)
+
+def edit(filepath: str) -> node:
+    """Opens a w3d file to change it and save it back.
+
+    The file is loaded lazily, keeping the chunks there is no decoder for
+    as node_raw, and stays open until root.close(). save() writes every
+    chunk that is the same as when it was read straight from the original
+    file, so only what was edited gets encoded and nothing the parser
+    doesn't know is lost. Call touch() on a node before changing its
+    fields.
+    """
+    print('edit: ' + filepath)
+    file = open(filepath, 'rb')
+    try:
+        buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:
+        # Empty files can't be mapped
+        buffer = b''
+
+    reader = ChunkReader(buffer, lazy=True, unknown='raw', track=True)
+
+    root = node_root()
+    root.children = parse_nodes(cast(BinaryIO, reader))
+    root.source = file
+    root.buffer = reader.view
+    return root
+
+class PatchWriter():
+    """Writes a file made mostly of byte ranges of another one.
+
+    The ranges are copied by the kernel when it can (copy_file_range, else
+    sendfile), from the buffer otherwise. Ranges that follow each other are
+    merged into one copy.
+    """
+    def __init__(self, source: int, buffer: memoryview, target: int):
+        self.source = source
+        self.buffer = buffer
+        self.target = target
+        self.start = 0
+        self.end = 0
+
+        if hasattr(os, 'copy_file_range'):
+            self.method = 'copy_file_range'
+        elif hasattr(os, 'sendfile'):
+            self.method = 'sendfile'
+        else:
+            self.method = 'write'
+
+    def copy(self, offset: int, size: int):
+        if offset != self.end or self.start == self.end:
+            self.flush()
+            self.start = offset
+        self.end = offset + size
+
+    def write(self, data):
+        self.flush()
+        self.write_all(memoryview(data))
+
+    def write_all(self, view: memoryview):
+        while len(view):
+            view = view[os.write(self.target, view):]
+
+    def flush(self):
+        offset = self.start
+        while offset < self.end:
+            count = self.copy_range(offset, self.end - offset)
+            if count == 0:
+                raise ParseError('The source file is shorter than it was when it was read')
+            offset += count
+
+        self.start = self.end = 0
+
+    def copy_range(self, offset: int, count: int) -> int:
+        # Falls back for good once a method is refused (other filesystem,
+        # old kernel...)
+        if self.method == 'copy_file_range':
+            try:
+                return os.copy_file_range(self.source, self.target, count, offset)
+            except OSError:
+                self.method = 'sendfile' if hasattr(os, 'sendfile') else 'write'
+
+        if self.method == 'sendfile':
+            try:
+                return os.sendfile(self.target, self.source, offset, count)
+            except OSError:
+                self.method = 'write'
+
+        view = self.buffer[offset:offset + count]
+        self.write_all(view)
+        return len(view)
+
+def measure_patched(n: node, clean: set) -> int:
+    """Sizes n for save_patched and returns its payload size.
+
+    The ids of the nodes that can be copied from the source as they are go
+    into clean; the other leaves are packed. A container is clean when its
+    children are still the chunks it was read with, all clean.
+    """
+    source = n._source
+    if source is not None and n._lazy is not None:
+        # Never even decoded
+        clean.add(id(n))
+        return source[1]
+
+    if not n.container or isinstance(n, node_raw):
+        if source is not None:
+            clean.add(id(n))
+            return source[1]
+        n.pack()
+        return n.size
+
+    size = 0
+    same = source is not None
+    for c in n.children:
+        offset = source[0] + 8 + size if same else None
+        size += 8 + measure_patched(c, clean)
+        same = same and id(c) in clean and c._source[0] == offset
+
+    if same and size == source[1]:
+        clean.add(id(n))
+
+    n.size = size
+    return size
+
+def write_patched(n: node, writer: PatchWriter, clean: set):
+    if id(n) in clean:
+        offset, size = n._source
+        writer.copy(offset, 8 + size)
+    elif n.container and not isinstance(n, node_raw):
+        writer.write(codecs['header'].pack(n.chunk_id, n.size | 0x80000000))
+        for c in n.children:
+            write_patched(c, writer, clean)
+    else:
+        buffer = bytearray(8 + n.size)
+        n.write_into(buffer, 0)
+        writer.write(buffer)
+
+def save_patched(root: node_root, filepath: str):
+    """save() for trees opened with edit().
+
+    Writes a temporary file next to filepath and moves it over filepath, so
+    the source can be saved onto. On POSIX systems the tree keeps reading
+    the original through the open file. Windows can't replace a file that
+    is open, so there the tree is closed first (see node_root.close).
+    """
+    clean = set()
+    for c in root.children:
+        measure_patched(c, clean)
+
+    target = os.path.abspath(filepath)
+    if os.path.exists(target):
+        mode = os.stat(target).st_mode & 0o7777
+    else:
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0o666 & ~umask
+
+    onto_source = (
+        os.name == 'nt' and os.path.exists(target)
+        and os.path.samestat(os.fstat(root.source.fileno()), os.stat(target))
+    )
+
+    fd, temp = tempfile.mkstemp(suffix='.w3d', dir=os.path.dirname(target))
+    try:
+        try:
+            writer = PatchWriter(root.source.fileno(), root.buffer, fd)
+            for c in root.children:
+                write_patched(c, writer, clean)
+            writer.flush()
+        finally:
+            os.close(fd)
+
+        os.chmod(temp, mode)
+        if onto_source:
+            root.close()
+        os.replace(temp, target)
+    except BaseException:
+        os.unlink(temp)
+        raise
+
 def save(root, filepath):
-    file = open(filepath, 'wb')
+    """Writes the children of root to a w3d file.
+
+    Every chunk is encoded and sized first, then copied into a single
+    buffer that is written out at once. Trees opened with edit() are
+    written by save_patched instead.
+    """
     print('save: ' + filepath)
+    if getattr(root, 'source', None) is not None:
+        save_patched(root, filepath)
+        return
+
+    root.pack()
+
+    buffer = bytearray(root.size)
+    offset = 0
     for c in root.children:
-        c.pack()
-        c.write(file)
-    file.close()
\ No newline at end of file
+        offset = c.write_into(buffer, offset)
+
+    with open(filepath, 'wb') as file:
+        file.write(buffer)
+
+# Worker processes of load_many, kept between calls
+pool: Optional[ProcessPoolExecutor] = None
+pool_workers = 0
+
+class shared_array():
+    """Lends numpy a shared memory block. Arrays made from it keep the
+    block mapped for as long as they live.
+    """
+    def __init__(self, block: shared_memory.SharedMemory):
+        self.block = block
+        self.__array_interface__ = {
+            'version': 3,
+            'data': (ctypes.addressof(ctypes.c_char.from_buffer(block.buf)), True),
+            'typestr': '|u1',
+            'shape': (block.size,),
+        }
+
+def get_pool(workers=None) -> ProcessPoolExecutor:
+    """Returns the load_many pool, started with workers processes (one per
+    core by default) if it isn't running with as many already.
+    """
+    global pool, pool_workers
+
+    workers = workers or os.cpu_count() or 1
+    if pool is None or pool_workers != workers:
+        shutdown_pool()
+        pool = ProcessPoolExecutor(workers)
+        pool_workers = workers
+
+    return pool
+
+def shutdown_pool():
+    """Stops the load_many worker processes.
+    """
+    global pool, pool_workers
+
+    if pool is not None:
+        pool.shutdown()
+    pool = None
+    pool_workers = 0
+
+def load_shared(filepath: str, unknown='skip', include=None, exclude=None):
+    """load_many's worker, loads a file and moves its arrays into a shared
+    memory block. Returns the tree, the name of the block and where each
+    array goes: (node, field, offset, dtype, shape, memoryview or not).
+    """
+    root = load(filepath, unknown=unknown, include=include, exclude=exclude)
+
+    # Blocks only outlive the worker's handle where they have a name that
+    # can be unlinked
+    shared = np is not None and os.name == 'posix'
+
+    arrays = []
+    refs = []
+    size = 0
+    for n in root.walk():
+        for key in n.fields():
+            value = getattr(n, key, None)
+            view = isinstance(value, memoryview)
+            if not view and not (np is not None and isinstance(value, np.ndarray)):
+                continue
+
+            if not shared:
+                if view:
+                    # Slices of the map can't be pickled
+                    setattr(n, key, bytes(value))
+                continue
+
+            if view:
+                value = np.frombuffer(value, dtype=np.uint8)
+
+            setattr(n, key, None)
+            arrays.append(value)
+            refs.append((n, key, size, value.dtype, value.shape, view))
+            size += (value.nbytes + 63) & ~63
+
+    if not arrays:
+        return root, None, refs
+
+    # Empty arrays still need a block to point into
+    block = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    # load_many takes the block over and unlinks it
+    resource_tracker.unregister('/' + block.name, 'shared_memory')
+
+    for value, ref in zip(arrays, refs):
+        data = np.ascontiguousarray(value).view(np.uint8).reshape(-1)
+        block.buf[ref[2]:ref[2] + data.size] = data
+    block.close()
+
+    return root, block.name, refs
+
+def attach_shared(root: node, name: Optional[str], refs: list) -> node:
+    """Puts the arrays load_shared moved to the block name back into root.
+    """
+    if name is None:
+        return root
+
+    block = shared_memory.SharedMemory(name=name)
+    # Gone from the system once the last array using it is
+    block.unlink()
+
+    data = np.asarray(shared_array(block))
+    for n, key, offset, dtype, shape, view in refs:
+        array = data[offset:offset + prod(shape) * dtype.itemsize].view(dtype).reshape(shape)
+        setattr(n, key, memoryview(array) if view else array)
+
+    return root
+
+def load_many(filepaths: List[str], workers=None, unknown='skip', include=None, exclude=None) -> List[node]:
+    """Loads w3d files on a pool of worker processes (see get_pool, the
+    pool is kept for the next call). Returns the trees in the order of
+    filepaths; the options are those of load().
+
+    Arrays come back through shared memory instead of being pickled, and
+    stay there (read only) for as long as they are used. The workers have
+    to be able to import this module: when they are spawned rather than
+    forked, import it as w3d_struct rather than through the add-on.
+    """
+    executor = get_pool(workers)
+    futures = [executor.submit(load_shared, f, unknown, include, exclude) for f in filepaths]
+
+    # Every result is attached, even after an error, so no block is left
+    # behind
+    roots = []
+    error = None
+    for future in futures:
+        try:
+            roots.append(attach_shared(*future.result()))
+        except Exception as e:
+            error = error or e
+
+    if isinstance(error, BrokenProcessPool):
+        shutdown_pool()
+    if error is not None:
+        raise error
+
+    return roots
@@ -1,7 +1,10 @@
-import copy
-import struct
 from typing import cast, Any, Dict, List
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 from . import w3d_struct
 
 def collect_render_objects(root):
@@ -22,22 +25,18 @@ def collect_render_objects(root):
     
 def make_pivots(root: w3d_struct.node, robj: Dict[str, w3d_struct.node]):
     pivotdict = {}
+
+    hierarchies = {}
+    for h in root.find('hierarchy'):
+        hh = cast(w3d_struct.node_hierarchy_header, h.get('hierarchy_header'))
+        hierarchies.setdefault(hh.Name, h)
     
     for hroot in root.find('hlod'):
         info = cast(w3d_struct.node_hlod_header, hroot.get('hlod_header'))
         if info is None:
             continue
 
-        hierarchy = None
-        hname = None
-        for h in root.find('hierarchy'):
-            hh = cast(w3d_struct.node_hierarchy_header, h.get('hierarchy_header'))
-            
-            hname = hh.Name
-            if info.HierarchyName == hname:
-                hierarchy = h
-                break
-
+        hierarchy = hierarchies.get(info.HierarchyName)
         if hierarchy is None:
             continue
 
@@ -80,6 +79,36 @@ def make_pivots(root: w3d_struct.node, robj: Dict[str, w3d_struct.node]):
     
     return pivotdict
 
+# channel Flags -> what the channel controls
+channel_types = {
+    0: 'X', 1: 'Y', 2: 'Z', # X/Y/Z translation
+    3: 'XR', 4: 'YR', 5: 'ZR', # X/Y/Z rotation
+    6: 'Q', # Quaternion
+}
+
+def link_pivot(pivots, hname: str, index: int):
+    """The pivot number index of the hierarchy hname, None if there is no
+    such pivot.
+    """
+    pivot = pivots.get(hname)
+    if pivot is None or index >= len(pivot['index']):
+        return None
+    return pivot['index'][index]
+
+def transitions(values):
+    """Run-length encodes values: returns the frames where a run starts (0
+    first) and the values of the runs. Arrays with numpy, lists without.
+    """
+    if np is not None:
+        values = np.asarray(values)
+        starts = np.ones(len(values), dtype=bool)
+        starts[1:] = values[1:] != values[:-1]
+        frames = np.flatnonzero(starts)
+        return frames, values[frames]
+
+    frames = [f for f, v in enumerate(values) if f == 0 or v != values[f - 1]]
+    return frames, [values[f] for f in frames]
+
 def make_anims(root: w3d_struct.node, pivots) -> Dict[str, dict]:
     animdict = {}
 
@@ -93,204 +122,272 @@ def make_anims(root: w3d_struct.node, pivots) -> Dict[str, dict]:
             'framerate': head.FrameRate, 'channels': [], 'bitchannels': [],
         }
 
-        bitchannels = animroot.find("bit_channel")
+        bitchannels = cast(List[w3d_struct.node_bit_channel], animroot.find("bit_channel"))
 
         for bitchan in bitchannels:
-            # TODO
-            pass
+            # Only the frames where the bit changes are kept
+            frames, values = transitions(bitchan.frames(head.NumFrames))
+            animdict[head.Name]['bitchannels'].append({
+                'type': 'VIS' if bitchan.Flags == 0 else '',
+                'frames': frames, 'values': values,
+                'pivot': link_pivot(pivots, head.HierarchyName, bitchan.Pivot),
+            })
 
         channels = cast(List[w3d_struct.node_animation_channel], animroot.find("animation_channel"))
 
         for chan in channels:
             chanout = {
-                'firstframe': chan.FirstFrame, 'lastframe': chan.LastFrame, 'data': []
+                'firstframe': chan.FirstFrame, 'lastframe': chan.LastFrame,
+                'type': channel_types.get(chan.Flags, ''), 'vectorlen': chan.VectorLen,
+                'data': chan.frames(),
+                'pivot': link_pivot(pivots, head.HierarchyName, chan.Pivot),
             }
+            animdict[head.Name]['channels'].append(chanout)
+
+    for animroot in root.find("compressed_animation"):
+        head = cast(w3d_struct.node_compressed_animation_header, animroot.get("compressed_animation_header"))
+        animdict[head.Name] = {
+            'hname': head.HierarchyName, 'name': head.Name, 'numframes': head.NumFrames,
+            'framerate': head.FrameRate, 'channels': [], 'bitchannels': [],
+        }
+
+        # Channels are expanded into one value per frame, like an
+        # uncompressed channel that covers the whole animation. Which kind
+        # they are depends on the header's Flavor.
+        channels = animroot.find("timecoded_animation_channel") + animroot.find("adaptivedelta_animation_channel")
 
-            # What the channel controls
-            type = ''
-            if chan.Flags == 0:
-                type = 'X' # X/Y/Z translation
-            elif chan.Flags == 1:
-                type = 'Y'
-            elif chan.Flags == 2:
-                type = 'Z'
-            elif chan.Flags == 3:
-                type = 'XR' # X/Y/Z rotation
-            elif chan.Flags == 4:
-                type = 'YR'
-            elif chan.Flags == 5:
-                type = 'ZR'
-            elif chan.Flags == 6:
-                type = 'Q' # Quaternion
-
-            chanout['type'] = type
-            chanout['vectorlen'] = chan.VectorLen
-
-            # Animation data
-            size = ((chan.LastFrame - chan.FirstFrame + 1) * chan.VectorLen) * 4
-            if size != len(chan.Data):
-                raise ValueError('animation channel has bad data length')
-
-            offset = 0
-            while offset < size:
-                data = struct.unpack_from(str(chan.VectorLen) + 'f', chan.Data, offset)
-
-                veclist = []
-                for i in range(0, chan.VectorLen):
-                    veclist.append(data[i])
-
-                chanout['data'].append(veclist)
-
-                offset += struct.calcsize(str(chan.VectorLen) + 'f')
-
-            # Link the pivot
-            pivotobj = None
-            for pivotn in pivots:
-                if pivotobj != None:
-                    break
-
-                if pivotn == head.HierarchyName:
-                    i = 0
-                    for p in pivots[pivotn]['index']:
-                        if i == chan.Pivot:
-                            pivotobj = p
-                            break
-
-                        i += 1
-
-            chanout['pivot'] = pivotobj
+        for chan in channels:
+            chanout = {
+                'firstframe': 0, 'lastframe': head.NumFrames - 1,
+                'type': channel_types.get(chan.Flags, ''), 'vectorlen': chan.VectorLen,
+                'data': chan.frames(head.NumFrames),
+                'pivot': link_pivot(pivots, head.HierarchyName, chan.Pivot),
+            }
             animdict[head.Name]['channels'].append(chanout)
 
     return animdict
     
+def weld_vertices(verts, dist: float):
+    """Merges the vertices that share a position, a spatial hash of cells of
+    dist: positions are rounded to the grid, and the vertices of a cell
+    become one, the first of them. Two vertices closer than dist across a
+    cell boundary stay apart.
+
+    Returns the positions of the vertices that are kept, their indices, and
+    the index among them each vertex became. Arrays with numpy, lists
+    without.
+    """
+    if np is not None:
+        verts = np.asarray(verts, dtype=np.float32).reshape(-1, 3)
+        cells = np.round(verts.astype(np.float64) / dist).astype(np.int64)
+
+        # Sorting brings the vertices of a cell together, a stable sort
+        # with the lowest index first
+        order = np.lexsort((cells[:, 2], cells[:, 1], cells[:, 0]))
+        cells = cells[order]
+        starts = np.ones(len(order), dtype=bool)
+        starts[1:] = (cells[1:] != cells[:-1]).any(axis=1)
+
+        # Cells numbered in the order of their first vertex
+        first = order[starts]
+        rank = np.empty(len(first), dtype=np.int64)
+        rank[np.argsort(first)] = np.arange(len(first))
+
+        remap = np.empty(len(order), dtype=np.int64)
+        remap[order] = rank[np.cumsum(starts) - 1]
+        kept = np.sort(first)
+        return verts[kept], kept, remap
+
+    kept = []
+    remap = []
+    cells = {}
+    for i, v in enumerate(verts):
+        key = tuple(round(c / dist) for c in v)
+        j = cells.get(key)
+        if j is None:
+            j = cells[key] = len(kept)
+            kept.append(i)
+        remap.append(j)
+    return [verts[i] for i in kept], kept, remap
+
+def mesh_faces(vindex, num_verts: int):
+    """Indices of the triangles (rows of 3 vertex indices) Blender can
+    have: all three vertices exist and differ, and no earlier triangle has
+    the same three. Array with numpy, list without.
+    """
+    if np is not None:
+        vindex = np.asarray(vindex, dtype=np.int64).reshape(-1, 3)
+        ok = (vindex < num_verts).all(axis=1)
+        ok &= (vindex[:, 0] != vindex[:, 1]) & (vindex[:, 1] != vindex[:, 2]) & (vindex[:, 0] != vindex[:, 2])
+        keep = np.flatnonzero(ok)
+
+        # The first triangle of each set of vertices, whatever their order
+        rows = np.sort(vindex[keep], axis=1)
+        first = np.unique(rows, axis=0, return_index=True)[1]
+        return keep[np.sort(first)]
+
+    keep = []
+    seen = set()
+    for i, f in enumerate(vindex):
+        key = frozenset(f)
+        if len(key) == 3 and max(key) < num_verts and key not in seen:
+            seen.add(key)
+            keep.append(i)
+    return keep
+
+def loop_values(values, loops):
+    """The per vertex values (rows) of every loop, loops being their vertex
+    indices, flat for foreach_set.
+    """
+    if np is not None:
+        return np.asarray(values, dtype=np.float32)[loops].ravel()
+    return [c for v in loops for c in values[v]]
+
+def loop_colors(dcg, loops):
+    """RGBA floats of every loop from the per vertex dcg colors, flat for
+    foreach_set. If any vertex is translucent the colors are the alpha
+    instead, as grey, and the alpha is left opaque.
+    """
+    if np is not None:
+        dcg = np.asarray(dcg, dtype=np.uint8).reshape(-1, 4)
+        channels = [3, 3, 3] if (dcg[:, 3] < 255).any() else [0, 1, 2]
+        out = np.ones((len(loops), 4), dtype=np.float32)
+        out[:, :3] = dcg[loops][:, channels] / 255
+        return out.ravel()
+
+    channels = [3, 3, 3] if any(c[3] < 255 for c in dcg) else [0, 1, 2]
+    out = []
+    for v in loops:
+        out += [dcg[v][i] / 255 for i in channels]
+        out.append(1.0)
+    return out
+
+def face_column(ids, index, count: int):
+    """The id of each of count faces: ids[index] if there are several ids
+    (one per vertex or per face), the only one otherwise.
+    """
+    if np is not None:
+        ids = np.asarray(ids, dtype=np.int64)
+        return ids[index] if len(ids) > 1 else np.full(count, ids[0], dtype=np.int64)
+    return [ids[i] for i in index] if len(ids) > 1 else [ids[0]] * count
+
 def mat_reduce(root: w3d_struct.node, ignore_lightmap: bool) -> list:
     """Runs through all the meshes and generate a list of materials.
+
+    Every face gets an integer signature: its surface, then for each pass
+    the ids of its vertex material, shader and textures. Faces with the same
+    signature share a material, numbered in the order they first appear.
     """
     materials = []
     mathash = {}
     
     for mesh in root.find('mesh'):
         meshinfo = cast(w3d_struct.node_mesh_header3, mesh.get('mesh_header3'))
-        verts = cast(w3d_struct.node_vertices, mesh.get('vertices')).vertices
         faces = cast(w3d_struct.node_triangles, mesh.get('triangles')).triangles
         mpass = cast(List[w3d_struct.node_material_pass], mesh.findRec('material_pass'))
         texnames = cast(List[w3d_struct.node_texture_name], mesh.findRec('texture_name'))
         vmnames = cast(List[w3d_struct.node_vertex_material_name], mesh.findRec('vertex_material_name'))
         vminfos = cast(List[w3d_struct.node_vertex_material_info], mesh.findRec('vertex_material_info'))
         shaders = cast(w3d_struct.node_shaders, mesh.getRec('shaders'))
-        
-        fmhash = {}
-        mesh.Materials = []
-        faceidx = 0
-        for face in faces:
-            # Gather face information
-            finfo = {}
-            
-            # get surface
-            finfo['surface'] = face['Attributes']
-            
-            finfo['mpass'] = []
-            for p in mpass:
-                vmids = cast(w3d_struct.node_vertex_material_ids, p.get('vertex_material_ids'))
-                shids = cast(w3d_struct.node_shader_ids, p.get('shader_ids'))
-
-                pinfo = { 'stages': [] }
-                
-                # get vertex material
-                ids = vmids.ids
-                pinfo['vmid'] = ids[face['Vindex'][0]] if len(ids) > 1 else ids[0]
-                
-                # remove lightmaps if not wanted
-                if ignore_lightmap and vmnames[pinfo['vmid']].name == 'Lightmap':
-                    mpass.remove(p)
+
+        count = len(faces)
+        if np is not None and isinstance(faces, np.ndarray):
+            columns = [faces['Attributes'].astype(np.int64)]
+            first = faces['Vindex'][:, 0]
+            faceidx = np.arange(count)
+        else:
+            columns = [[f['Attributes'] for f in faces]]
+            first = [f['Vindex'][0] for f in faces]
+            faceidx = range(count)
+
+        # Number of texture stages of each pass
+        layout = []
+        for p in mpass:
+            vmids = cast(w3d_struct.node_vertex_material_ids, p.get('vertex_material_ids'))
+            shids = cast(w3d_struct.node_shader_ids, p.get('shader_ids'))
+
+            # vertex material of the first vertex
+            vmcol = face_column(vmids.ids, first, count)
+
+            # remove lightmaps if not wanted
+            if ignore_lightmap:
+                used = np.unique(vmcol).tolist() if np is not None else set(vmcol)
+                if any(vmnames[i].name == 'Lightmap' for i in used):
                     continue
-                
-                # get shader
-                ids = shids.ids
-                pinfo['sid'] = ids[faceidx] if len(ids) > 1 else ids[0]
-                
-                # get textures
-                stage = p.get('texture_stage')
-                if stage is not None:
-                    for tex in stage.findRec('texture_ids'):
-                        ids = tex.ids
-                        pinfo['stages'].append(ids[faceidx] if len(ids) > 1 else ids[0])
-                
-                finfo['mpass'].append(pinfo)
-            
-            faceidx += 1
-            
-            # Reduce face info to materials
-            h = make_hash(finfo)
-            if h in fmhash:
-                face['Mindex'] = fmhash[h]
-                continue
-            
-            # Material are stored in an array with the mesh
-            # and material index is stored with face
-            face['Mindex'] = len(mesh.Materials)
-            fmhash[h] = len(mesh.Materials)
-            
+
+            columns.append(vmcol)
+            columns.append(face_column(shids.ids, faceidx, count))
+
+            stages = 0
+            stage = p.get('texture_stage')
+            if stage is not None:
+                for tex in stage.findRec('texture_ids'):
+                    columns.append(face_column(tex.ids, faceidx, count))
+                    stages += 1
+            layout.append(stages)
+
+        # Material are stored in an array with the mesh
+        # and the material index of each face in Mindex.
+        # np.unique has a fixed cost that only pays off on bigger meshes
+        if np is not None and count >= 256:
+            table = np.stack(columns, axis=1)
+            rows, firsts, inverse = np.unique(table, axis=0, return_index=True, return_inverse=True)
+
+            # np.unique sorts the signatures, number them by first face instead
+            order = np.argsort(firsts)
+            rank = np.empty(len(order), dtype=np.int64)
+            rank[order] = np.arange(len(order))
+
+            mesh.Mindex = rank[inverse.reshape(-1)]
+            signatures = [tuple(row) for row in rows[order].tolist()]
+        else:
+            if np is not None:
+                columns = [np.asarray(c).tolist() for c in columns]
+
+            fmhash = {}
+            mesh.Mindex = []
+            signatures = []
+            for sig in zip(*columns):
+                i = fmhash.get(sig)
+                if i is None:
+                    i = fmhash[sig] = len(signatures)
+                    signatures.append(sig)
+                mesh.Mindex.append(i)
+
+        mesh.Materials = []
+        for sig in signatures:
             # Compile material
             mat = { 'mpass': [] }
-            mat['surface'] = finfo['surface']
+            mat['surface'] = sig[0]
             mat['sort_level'] = meshinfo.SortLevel
-            
-            for pinfo in finfo['mpass']:
+
+            key = [sig[0], meshinfo.SortLevel]
+            col = 1
+            for stages in layout:
+                vmid, sid = sig[col], sig[col + 1]
                 p = { 'vertex_material': {}, 'stages': [] }
-                p['shader'] = shaders.shaders[pinfo['sid']]
-                p['vertex_material']['name'] = vmnames[pinfo['vmid']].name
-                p['vertex_material']['info'] = vminfos[pinfo['vmid']]
-                for id in pinfo['stages']:
+                p['shader'] = shaders.shaders[sid]
+                p['vertex_material']['name'] = vmnames[vmid].name
+                p['vertex_material']['info'] = vminfos[vmid]
+                for id in sig[col + 2:col + 2 + stages]:
                     if id < len(texnames):
                         p['stages'].append({ 'name': texnames[id].name })
                 mat['mpass'].append(p)
-            
+                col += 2 + stages
+
+                info = vminfos[vmid]
+                key.append((
+                    p['shader'].values(), p['vertex_material']['name'],
+                    tuple(getattr(info, k, None) for k in type(info).__slots__),
+                    tuple(t['name'] for t in p['stages']),
+                ))
+
             # Reduce materials to share between meshes
-            h = make_hash(mat)
-            if h in mathash:
-                mat = mathash[h]
-            else:
-                mathash[h] = mat
+            shared = mathash.setdefault(tuple(key), mat)
+            if shared is mat:
                 materials.append(mat)
+            mat = shared
             
             mesh.Materials.append(mat)
     
     return materials
-    
-# thanks jomido @ stackoverflow!
-DictProxyType = type(object.__dict__)
-
-def make_hash(o):
-
-    """
-    Makes a hash from a dictionary, list, tuple or set to any level, that 
-    contains only other hashable types (including any lists, tuples, sets, and
-    dictionaries). In the case where other kinds of objects (like classes) need 
-    to be hashed, pass in a collection of object attributes that are pertinent. 
-    For example, a class can be hashed in this fashion:
-
-        make_hash([cls.__dict__, cls.__name__])
-
-    A function can be hashed like so:
-
-        make_hash([fn.__dict__, fn.__code__])
-    """
-
-    if type(o) == DictProxyType:
-        o2 = {}
-        for k, v in o.items():
-            if not k.startswith("__"):
-                o2[k] = v
-        o = o2    
-
-    if isinstance(o, set) or isinstance(o, tuple) or isinstance(o, list):
-        return tuple([make_hash(e) for e in o])
-    elif not isinstance(o, dict):
-        return hash(o)
-
-    new_o = copy.deepcopy(o)
-    for k, v in new_o.items():
-        new_o[k] = make_hash(v)
-
-    return hash(tuple(frozenset(new_o.items())))